@@ -18,13 +18,33 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from mdshare import fetch, Repository
-from mdshare.utils import file_hash
+from mdshare.utils import file_hash, compress_blocks
+from mdshare.utils import LoadError, VerifiedStream
+from mdshare.manifest import stat_signature
+from mdshare.mirrors import Mirrors
 from argparse import ArgumentParser
-from yaml import load, dump
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from tempfile import TemporaryFile
+from yaml import safe_load, dump
 import fnmatch
+import hashlib
 import tarfile
+import gzip
+import json
+import time
+import shutil
+import copy
+import sys
 import os
 
+# files modified this shortly before being hashed are hashed again on the
+# next build, as their mtime may not reveal a later modification
+RACY_NS = 2 * 10**9
+# mtime of all container members (2000-01-01), so that containers only
+# change with their content
+CONTAINER_MTIME = 946684800
+
 
 def filter_files(files, patterns):
     """Keep only those files which match at least on pattern"""
@@ -35,24 +55,278 @@ def filter_files(files, patterns):
     return list(sorted(include))
 
 
-def get_metadata(file):
-    """Get a dict with file hash and size"""
-    return dict(
-        hash=file_hash(file),
+def get_metadata(file, digests=()):
+    """Get a dict with file hash(es) and size, reading the file once"""
+    hashes = {
+        algorithm: hashlib.new(algorithm)
+        for algorithm in ('md5', *digests)}
+    with open(file, 'rb') as fh:
+        while True:
+            data = fh.read(65536)
+            if not data:
+                break
+            for hash_ in hashes.values():
+                hash_.update(data)
+    metadata = dict(
+        hash=hashes.pop('md5').hexdigest(),
         size=os.path.getsize(file))
+    for algorithm, hash_ in hashes.items():
+        metadata[algorithm] = hash_.hexdigest()
+    return metadata
+
+
+def hash_file(file, digests=()):
+    """Get the stat signature, the time of hashing, and the metadata of a
+    file; the signature is taken first so that concurrent changes show"""
+    signature = stat_signature(file)
+    # time.time_ns() requires Python 3.7
+    hashed = int(time.time() * 10**9)
+    return signature, hashed, get_metadata(file, digests)
+
+
+class BuildManifest(object):
+    """Metadata of previous builds keyed by path, size, mtime, and inode
+
+    Files whose stat signature is unchanged are not hashed again, so a
+    rebuild only reads the files which changed.
+    """
+    filename = '.mdshare-build-manifest.json'
+
+    def __init__(self, path=None):
+        self.path = self.filename if path is None else path
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            data = dict()
+        self.files = data.get('files', dict())
+        self.containers = data.get('containers', dict())
+
+    def lookup(self, file, digests=()):
+        """Return the recorded metadata of an unchanged file or None"""
+        entry = self.files.get(file)
+        if entry is None:
+            return None
+        try:
+            signature = stat_signature(file)
+        except FileNotFoundError:
+            return None
+        if entry['stat'] != signature or (
+                signature[1] >= entry['hashed'] - RACY_NS):
+            return None
+        if any(digest not in entry['metadata'] for digest in digests):
+            return None
+        return dict(entry['metadata'])
+
+    def record(self, file, signature, hashed, metadata):
+        self.files[file] = dict(
+            stat=signature, hashed=hashed, metadata=metadata)
+
+    def lookup_container(self, container, members, recipe):
+        """Return the recorded metadata of a container or None if it must
+        be rebuilt
+
+        Arguments:
+            container (str): name of the container
+            members (dict): member -> md5 hash
+            recipe (dict): settings which affect the container's bytes
+        """
+        entry = self.containers.get(container)
+        if entry is None or entry['members'] != members or (
+                entry['recipe'] != recipe):
+            return None
+        try:
+            signature = stat_signature(container)
+        except FileNotFoundError:
+            return None
+        # containers are written by the build itself, so an unchanged
+        # signature suffices
+        if entry['stat'] != signature:
+            return None
+        return dict(entry['metadata'])
+
+    def record_container(
+            self, container, members, recipe, signature, metadata):
+        self.containers[container] = dict(
+            members=members, recipe=recipe, stat=signature,
+            metadata=metadata)
+
+    def save(self):
+        self.files = {
+            file: entry for file, entry in self.files.items()
+            if os.path.exists(file)}
+        self.containers = {
+            container: entry
+            for container, entry in self.containers.items()
+            if os.path.exists(container)}
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(dict(files=self.files, containers=self.containers), fh)
+        os.replace(tmp, self.path)
+
+
+def hash_files(files, digests=(), manifest=None, max_workers=None):
+    """Get the metadata of many files, hashing changed files in parallel
+
+    Arguments:
+        files (list of str): files to be hashed
+        digests (list of str): additional hashlib algorithms
+        manifest (BuildManifest): metadata of previous builds, which is
+            updated and saved (every minute and at the end)
+        max_workers (int): number of hashing processes, defaults to the
+            number of cores
+    """
+    if manifest is None:
+        manifest = BuildManifest()
+    metadata = dict()
+    pending = []
+    for file in files:
+        known = manifest.lookup(file, digests)
+        if known is None:
+            pending.append(file)
+        else:
+            metadata[file] = known
+    print(f'hashing {len(pending)} of {len(files)} files')
+    if pending:
+        # large files first, so that no worker is left with one at the end
+        pending.sort(key=os.path.getsize, reverse=True)
+        max_workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, min(64, len(pending) // (4 * max_workers)))
+        saved = time.monotonic()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for file, (signature, hashed, data) in zip(pending, executor.map(
+                    partial(hash_file, digests=digests), pending,
+                    chunksize=chunksize)):
+                manifest.record(file, signature, hashed, data)
+                metadata[file] = data
+                if time.monotonic() - saved > 60:
+                    manifest.save()
+                    saved = time.monotonic()
+    manifest.save()
+    return {file: metadata[file] for file in files}
+
+
+def reproducible(info):
+    """Strip the metadata which differs between builds from a tar member"""
+    info.mtime = CONTAINER_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mode = 0o755 if info.mode & 0o111 else 0o644
+    return info
+
+
+def make_container(container, files, block_size=None):
+    """Make a reproducible .tar.gz container from a list of files
+
+    Members are added in sorted order with fixed metadata, and the gzip
+    header carries neither a timestamp nor a filename, so the container
+    only changes with its members' content.
 
+    With a block_size, the tar stream is compressed in independent blocks
+    on all cores and the list of block offsets is returned.
+    """
+    with TemporaryFile() as tmp:
+        with tarfile.open(
+                fileobj=tmp, mode='w', format=tarfile.PAX_FORMAT) as fh:
+            for file in sorted(files):
+                fh.add(file, filter=reproducible)
+        tmp.seek(0)
+        with open(container, 'wb') as fh:
+            if block_size is not None:
+                return compress_blocks(tmp, fh, block_size)
+            with gzip.GzipFile(
+                    filename='', mode='wb', fileobj=fh, mtime=0) as gz:
+                shutil.copyfileobj(tmp, gz, 2**20)
+    return None
 
-def make_container(container, files):
-    """Make a .tar.gz container from a list of files"""
-    with tarfile.open(container, 'w:gz') as fh:
-        for file in files:
-            fh.add(file)
 
+def build_container(container, files, block_size=None, digests=()):
+    """Make a container via a temporary file and get its stat signature
+    and metadata"""
+    tmp = f'{container}.{os.getpid()}.tmp'
+    try:
+        blocks = make_container(tmp, files, block_size=block_size)
+        os.replace(tmp, container)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    signature, _, metadata = hash_file(container, digests)
+    if blocks is not None:
+        metadata['blocks'] = blocks
+    return signature, metadata
 
-def build(template_file):
-    """Build the catalogues from the given template"""
+
+def build_containers(
+        containers, index, digests=(), block_size=None, manifest=None,
+        max_workers=None):
+    """Build all stale containers in parallel
+
+    Containers whose member set, member hashes, and build settings are
+    unchanged since the last build are skipped.
+
+    Arguments:
+        containers (dict): container -> list of member patterns
+        index (dict): metadata of all included files
+        digests (list of str): additional hashlib algorithms
+        block_size (int): see make_container()
+        manifest (BuildManifest): metadata of previous builds, which is
+            updated and saved
+        max_workers (int): number of processes, defaults to the number of
+            cores; block-compressed containers use all cores each and are
+            built one at a time
+    """
+    if manifest is None:
+        manifest = BuildManifest()
+    recipe = dict(
+        block_size=block_size, mtime=CONTAINER_MTIME,
+        digests=sorted(digests))
+    members = {
+        container: filter_files(list(index), patterns)
+        for container, patterns in containers.items()}
+    hashes = {
+        container: {member: index[member]['hash'] for member in files}
+        for container, files in members.items()}
+    metadata = dict()
+    stale = []
+    for container in containers:
+        known = manifest.lookup_container(
+            container, hashes[container], recipe)
+        if known is None:
+            stale.append(container)
+        else:
+            metadata[container] = known
+    print(f'building {len(stale)} of {len(containers)} containers')
+    if stale:
+        if block_size is not None:
+            max_workers = 1
+        max_workers = min(len(stale), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                container: executor.submit(
+                    build_container, container, members[container],
+                    block_size=block_size, digests=digests)
+                for container in stale}
+            for container, future in futures.items():
+                signature, data = future.result()
+                manifest.record_container(
+                    container, hashes[container], recipe, signature, data)
+                metadata[container] = data
+        manifest.save()
+    for container in containers:
+        metadata[container]['members'] = {
+            member: dict(index[member]) for member in members[container]}
+    return {container: metadata[container] for container in containers}
+
+
+def build(template_file, max_workers=None):
+    """Build the catalogues from the given template
+
+    Files are hashed and containers are built on max_workers processes
+    (defaults to the number of cores); unchanged files take their hashes
+    and unchanged containers their metadata from the build manifest.
+    """
     with open(template_file, 'r') as fh:
-        template = load(fh)
+        template = safe_load(fh)
 
     for key in ('url', 'include', 'containers'):
         if key not in template:
@@ -62,14 +336,21 @@ def build(template_file):
         url=template['url'],
         index=dict(),
         containers=dict())
+    if template.get('mirrors'):
+        db['mirrors'] = list(template['mirrors'])
+    digests = [
+        digest for digest in template.get('digests', []) if digest != 'md5']
 
-    files = filter_files(os.listdir(), template['include'])
-    for file in files:
-        db['index'].update({file: get_metadata(file)})
-
-    for container, patterns in template['containers'].items():
-        make_container(container, filter_files(files, patterns))
-        db['containers'].update({container: get_metadata(container)})
+    files = [
+        file for file in filter_files(os.listdir(), template['include'])
+        if file != BuildManifest.filename]
+    manifest = BuildManifest()
+    db['index'].update(hash_files(
+        files, digests, manifest=manifest, max_workers=max_workers))
+    db['containers'].update(build_containers(
+        template['containers'], db['index'], digests,
+        block_size=template.get('block_size'), manifest=manifest,
+        max_workers=max_workers))
 
     catalogue = f'{template["name"]}.yaml'
     with open(catalogue, 'w') as fh:
@@ -103,14 +384,110 @@ def test(catalogue_file, checksum_file):
         except TypeError:
             for local_file in local_files:
                 os.remove(local_file)
-    os.rmdir(working_directory)
+    # fetch() leaves its manifest behind
+    shutil.rmtree(working_directory)
+
+
+def check_headers(repository, file):
+    """Check the status and Content-Length of a file without its body"""
+    size = repository.size(file)
+    response = repository._get_connection().head(repository.url_for(
+        file, mirror=repository.mirrors.urls[0]))
+    response.raise_for_status()
+    length = response.headers.get('Content-Length')
+    if length is not None and int(length) != size:
+        raise LoadError(file, f'Content-Length is {length}, not {size}')
+    return 0
+
+
+def check_hash(repository, file):
+    """Stream a file through the hasher without writing it to disk"""
+    with VerifiedStream(repository, file) as stream:
+        for _ in stream:
+            pass
+    return stream.position
+
+
+def verify(
+        catalogue_file, checksum_file, max_workers=8, headers=False,
+        headers_only=False):
+    """Check all files of a catalogue on all of its mirrors
+
+    Arguments:
+        catalogue_file (str): the catalogue
+        checksum_file (str): md5 checksum file of the catalogue
+        max_workers (int): number of concurrent requests
+        headers (boolean): check status and Content-Length first and only
+            hash the files which pass
+        headers_only (boolean): only check status and Content-Length
+
+    Returns a summary dict with one record per file and mirror.
+    """
+    from requests import RequestException
+    repository = Repository(catalogue_file, checksum_file)
+    repository._get_connection(pool_maxsize=max_workers)
+    files = list(repository.index) + list(repository.containers)
+    # one view per mirror, so that each mirror is checked on its own
+    views = []
+    for mirror in repository.mirrors.urls:
+        view = copy.copy(repository)
+        view.mirrors = Mirrors([mirror])
+        views.append(view)
+    checks = ['headers'] if headers or headers_only else []
+    if not headers_only:
+        checks.append('hash')
+    start = time.monotonic()
+
+    def run(task):
+        check, view, file = task
+        record = dict(
+            file=file, mirror=view.mirrors.urls[0], check=check,
+            size=view.size(file), ok=True, error=None, bytes=0)
+        began = time.monotonic()
+        try:
+            if check == 'headers':
+                record['bytes'] = check_headers(view, file)
+            else:
+                record['bytes'] = check_hash(view, file)
+        except (LoadError, RequestException, OSError, ValueError) as e:
+            record.update(ok=False, error=f'{type(e).__name__}: {e}')
+        record['seconds'] = time.monotonic() - began
+        record['throughput'] = record['bytes'] / record['seconds'] if (
+            record['bytes'] and record['seconds'] > 0) else None
+        return record
+
+    records = []
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for check in checks:
+            tasks = [
+                (check, view, file) for view in views for file in files
+                if (view.mirrors.urls[0], file) not in failed]
+            for record in executor.map(run, tasks):
+                records.append(record)
+                if not record['ok']:
+                    failed.add((record['mirror'], record['file']))
+    seconds = time.monotonic() - start
+    nbytes = sum(record['bytes'] for record in records)
+    return dict(
+        catalogue=catalogue_file,
+        mirrors=repository.mirrors.urls,
+        checks=checks,
+        files=len(files),
+        failed=[
+            dict(file=file, mirror=mirror)
+            for mirror, file in sorted(failed)],
+        bytes=nbytes,
+        seconds=seconds,
+        throughput=nbytes / seconds if seconds > 0 else None,
+        records=records)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument(
         'mode',
-        help='action to take [ build | test ]',
+        help='action to take [ build | test | verify ]',
         metavar='MODE')
     parser.add_argument(
         'yaml',
@@ -121,11 +498,40 @@ if __name__ == '__main__':
         help='md5 checksum file of the catalogue',
         metavar='FILE',
         nargs='?')
+    parser.add_argument(
+        '-j', '--workers',
+        help='number of processes for hashing (build, defaults to all'
+        ' cores) or of concurrent requests (verify, defaults to 8)',
+        type=int,
+        metavar='N')
+    parser.add_argument(
+        '--headers',
+        help='verify: check status and Content-Length before hashing',
+        action='store_true')
+    parser.add_argument(
+        '--headers-only',
+        help='verify: only check status and Content-Length',
+        action='store_true')
+    parser.add_argument(
+        '--summary',
+        help='verify: write the JSON summary to FILE instead of stdout',
+        metavar='FILE')
     args = parser.parse_args()
 
     if args.mode.lower() == 'build':
-        build(args.yaml)
+        build(args.yaml, max_workers=args.workers)
     elif args.mode.lower() == 'test':
         test(args.yaml, args.md5)
+    elif args.mode.lower() == 'verify':
+        summary = verify(
+            args.yaml, args.md5, max_workers=args.workers or 8,
+            headers=args.headers, headers_only=args.headers_only)
+        if args.summary is None:
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.summary, 'w') as fh:
+                json.dump(summary, fh, indent=2)
+        sys.exit(1 if summary['failed'] else 0)
     else:
         raise ValueError(f'Unsupported mode: {args.mode}')
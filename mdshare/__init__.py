@@ -21,33 +21,70 @@ __email__ = 'christoph.wehmeyer@fu-berlin.de'
 __credits__ = ['Guillermo Pérez-Hernández', 'Martin K. Scherer'],
 
 
-from pkg_resources import get_distribution, DistributionNotFound
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-    __version__ = 'unknown'
-del get_distribution, DistributionNotFound
-
-
-from .repository import Repository
-from os.path import dirname, join
-from warnings import warn
-try:
-    default_repository = Repository(
-        join(dirname(__file__), 'data', 'mdshare-catalogue.yaml'),
-        join(dirname(__file__), 'data', 'mdshare-catalogue.md5'))
-except FileNotFoundError:
-    warn('Cannot build the default repository: missing file(s)!')
-    default_repository = None
-except RuntimeError as e:
-    warn(f'Cannot build the default repository: {e.args[0]}')
-    default_repository = None
-del dirname, join, warn
+from .repository import Repository, RepositoryGroup
+from .cache import Cache
+from .bandwidth import set_bandwidth_limit
+from .metrics import FetchSummary, JsonLinesExporter, PrometheusExporter
+from threading import Lock
+_default_repository_lock = Lock()
+del Lock
 
 
-from .api import load_repository, search, catalogue, fetch
-from .utils import LoadError
+def _build_default_repository():
+    from os.path import dirname, join
+    from warnings import warn
+    try:
+        return Repository(
+            join(dirname(__file__), 'data', 'mdshare-catalogue.yaml'),
+            join(dirname(__file__), 'data', 'mdshare-catalogue.md5'))
+    except FileNotFoundError:
+        warn('Cannot build the default repository: missing file(s)!')
+    except RuntimeError as e:
+        warn(f'Cannot build the default repository: {e.args[0]}')
+    return None
+
+
+def _get_version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # Python < 3.8
+        from pkg_resources import get_distribution, DistributionNotFound
+        try:
+            return get_distribution(__name__).version
+        except DistributionNotFound:
+            return 'unknown'
+    try:
+        return version(__name__)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+from types import ModuleType
+import sys
 
 
-def load(*args, **kwargs):
-    raise NotImplementedError('use fetch')
+class _LazyModule(ModuleType):
+    # version and default repository are only looked up on first access;
+    # a module subclass rather than a module __getattr__ (Python >= 3.7)
+    def __getattr__(self, name):
+        if name == '__version__':
+            self.__version__ = _get_version()
+            return self.__version__
+        if name == 'default_repository':
+            with _default_repository_lock:
+                if 'default_repository' not in self.__dict__:
+                    self.default_repository = _build_default_repository()
+            return self.default_repository
+        raise AttributeError(
+            f'module {self.__name__!r} has no attribute {name!r}')
+
+
+sys.modules[__name__].__class__ = _LazyModule
+del ModuleType, sys
+
+
+from .api import load_repository, search, catalogue, fetch
+from .api import afetch, afetch_many, load, open_npz
+from .api import fetch_stream, fetch_bytes
+from .utils import LoadError
@@ -16,36 +16,55 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import sys
-import tarfile
+from contextlib import ExitStack
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from tempfile import mkdtemp
-from .utils import LoadError, download_wrapper
+from threading import Event
+from .utils import LoadError, download_wrapper, extract_container
+from .utils import attempt_to_download_and_extract
+from .utils import VerifiedStream, interruptible
 from .repository import Repository
-from . import default_repository
+from .cache import Cache, materialize
+from .manifest import Manifest, VERIFY_MODES
+from .progress import Progress, ProgressBars
+from .locking import FileLock
+from .metrics import FetchSummary
 
 
-def load_repository(catalogue_file, checksum_file=None):
+def get_default_repository():
+    """Return the default repository, building it on first use."""
+    from . import default_repository
+    return default_repository
+
+
+def load_repository(catalogue_file, checksum_file=None, transport=None):
     """Load a repository catalogue from file
 
     Arguments:
         catalogue_file (str): filename of the catalogue
         checksum_file (str): filename of the catalogue's checksum
+        transport (str or Transport): 'requests' (default), 'urllib3',
+            'file', or a Transport instance
     """
-    return Repository(catalogue_file, checksum_file)
+    return Repository(catalogue_file, checksum_file, transport=transport)
 
 
-def search(filename_pattern, repository=None):
+def search(filename_pattern, repository=None, regex=False):
     """Returns a list of available files matching a filename_pattern.
 
     Arguments:
-        filename_pattern (str): filename pattern, allows for Unix shell-style wildcards
+        filename_pattern (str): filename pattern, allows for Unix shell-style wildcards;
+            a list of patterns returns the union of all matches
         repository (Repository): repository object
+        regex (boolean): interpret filename_pattern as regular expression(s)
     """
     if repository is None:
-        repository = default_repository
+        repository = get_default_repository()
     if not isinstance(repository, Repository):
         raise TypeError('received {type(repository)} instead of Repository')
-    return repository.search(filename_pattern)
+    return repository.search(filename_pattern, regex=regex)
 
 
 def catalogue(repository=None):
@@ -55,7 +74,7 @@ def catalogue(repository=None):
         repository (Repository): repository object
     """
     if repository is None:
-        repository = default_repository
+        repository = get_default_repository()
     if not isinstance(repository, Repository):
         raise TypeError('received {type(repository)} instead of Repository')
     print(repository)
@@ -63,7 +82,9 @@ def catalogue(repository=None):
 
 def fetch(
         remote_filename, working_directory='.', repository=None,
-        max_attempts=3, force=False, show_progress=True):
+        max_attempts=3, force=False, show_progress=True, max_workers=1,
+        segments=1, cache=None, verify='fast', stream_containers=True,
+        on_progress=None, summary=None, stop=None):
     """Download a file if it is not already at the traget location.
 
     Arguments:
@@ -73,98 +94,385 @@ def fetch(
         max_attempts (int): number of download attempts
         force (boolean): enforce download even if file exists
         show_progress (boolean): show download progress
+        max_workers (int): number of files to download concurrently
+        segments (int): number of concurrent byte ranges for large files
+        cache (Cache): shared cache to materialize files from, True for
+            the default cache location
+        verify (str): check of existing files: 'none' (existence only),
+            'fast' (size/mtime/inode manifest, hash on mismatch), 'full'
+        stream_containers (boolean): extract containers while downloading
+            instead of saving the archive first (not used with a cache)
+        on_progress (callable): receives a ProgressEvent about every 0.1s
+            per downloaded file (and when a file is complete)
+        summary (FetchSummary): receives the timings of this call; the
+            repository's observers receive it in any case
+        stop (threading.Event): once set, running downloads raise
+            concurrent.futures.CancelledError after their current chunk
     """
     if repository is None:
-        repository = default_repository
+        repository = get_default_repository()
     if not isinstance(repository, Repository):
         raise TypeError('received {type(repository)} instead of Repository')
+    if max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+    if verify not in VERIFY_MODES:
+        raise ValueError(f'unsupported verify mode: {verify}')
+    if cache is True:
+        cache = Cache()
+    elif cache is not None and not isinstance(cache, Cache):
+        raise TypeError(f'received {type(cache)} instead of Cache')
     if working_directory is None:
         working_directory = mkdtemp()
     else:
         os.makedirs(working_directory, exist_ok=True)
+    if summary is None:
+        summary = FetchSummary()
+    summary.pattern = remote_filename
     try:
-        import progress_reporter
-        have_progress_reporter = True
-    except ImportError:
-        have_progress_reporter = False
+        with summary.phase('lookup'):
+            stack = repository.stack(remote_filename)
+        if len(stack) == 0:
+            raise LoadError(remote_filename, 'no match in repository')
+        metrics = [summary.file(item['file']) for item in stack]
 
-    stack = repository.stack(remote_filename)
-    if len(stack) == 0:
-        raise LoadError(remote_filename, 'no match in repository')
+        # containers whose members are all present need not be downloaded
+        manifest = Manifest(working_directory)
+        extracted = dict()
+        with manifest.batch():
+            for item in stack:
+                if item['unpack'] and not force:
+                    members = repository.members(item['file'])
+                    if members and manifest.verify_all(
+                            members, mode=verify):
+                        extracted[item['file']] = [
+                            os.path.join(working_directory, member)
+                            for member in members]
 
-    if have_progress_reporter and show_progress:
-        callbacks = []
-        pg = progress_reporter.ProgressReporter_()
-        total = sum(item['size'] for item in stack)
-
-        def update(n, blk, stage):
-            downloaded = n * blk
-            inc = max(
-                0, downloaded - pg._prog_rep_progressbars[stage].n)
-            pg.update(inc, stage=stage)
-            # total progress
+        # files with identical content are downloaded once and linked
+        duplicates, primaries = dict(), dict()
+        for item in stack:
+            if not item['unpack']:
+                digest = repository.digest(item['file'])
+                if digest in primaries:
+                    duplicates[item['file']] = primaries[digest]
+                else:
+                    primaries[digest] = item['file']
+
+        listeners = [] if on_progress is None else [on_progress]
+        bars = None
+        if show_progress:
             try:
-                pg.update(inc, stage=-1)
-            except RuntimeError:
+                bars = ProgressBars()
+                listeners.append(bars)
+            except ImportError:
                 pass
+        callbacks = []
+        for item in stack:
+            path = os.path.join(working_directory, item['file'])
+            present = os.path.exists(path) and (
+                verify == 'none' or os.path.getsize(path) == item['size'])
+            if not listeners or (
+                    item['file'] in extracted or item['file'] in duplicates):
+                callbacks.append(None)
+            elif not force and (present or (
+                    cache is not None
+                    and repository.hash(item['file']) in cache)):
+                callbacks.append(None)
+            else:
+                if bars is not None:
+                    bars.register(item['file'], item['size'])
+                callbacks.append(
+                    Progress(item['file'], item['size'], listeners))
+        if bars is not None:
+            bars.register_total()
+        if stop is not None:
+            callbacks = [
+                interruptible(callback, stop) for callback in callbacks]
 
-        from functools import partial
-        tqdm_args = dict(unit='B', file=sys.stdout, unit_scale=True)
+        # members' digests, computed while the containers are extracted
+        checksums = dict()
 
-        n_progress_bars = 0
-        for stage, item in enumerate(stack):
-            if working_directory is not None:
-                path = os.path.join(working_directory, item['file'])
-                if os.path.exists(path) and not force:
-                    callbacks.append(None)
-                else:
-                    pg.register(
-                        item['size'],
-                        description=f'downloading {item["file"]}',
-                        tqdm_args=tqdm_args,
-                        stage=stage)
-                    callbacks.append(partial(update, stage=stage))
-                    n_progress_bars += 1
-        if n_progress_bars > 1:
-            pg.register(
-                total, description='total', tqdm_args=tqdm_args, stage=-1)
-    else:
-        from unittest.mock import MagicMock
-        pg = MagicMock()
-        callbacks = [None] * len(stack)
-
-    result = []
-    with pg.context():
-        for item, progress in zip(stack, callbacks):
-            file = download_wrapper(
+        def download(item, progress, metrics):
+            if item['file'] in extracted:
+                return extracted[item['file']]
+            if item['file'] in duplicates:
+                return None
+            if item['unpack'] and stream_containers and cache is None and (
+                    force or not os.path.exists(
+                        os.path.join(working_directory, item['file']))):
+                # one process extracts the container while the others wait
+                with FileLock(os.path.join(
+                        working_directory, item['file'])) as lock:
+                    members = repository.members(item['file'])
+                    if (not force or lock.waited) and members and (
+                            manifest.verify_all(members, mode=verify)):
+                        return [
+                            os.path.join(working_directory, member)
+                            for member in members]
+                    return attempt_to_download_and_extract(
+                        repository,
+                        item['file'],
+                        working_directory,
+                        max_attempts=max_attempts,
+                        callback=progress,
+                        metrics=metrics,
+                        checksums=checksums)
+            return download_wrapper(
                 repository,
                 item['file'],
                 working_directory=working_directory,
                 max_attempts=max_attempts,
                 force=force,
-                callback=progress)
-            if item['unpack']:
-
-                def inspect(members):
-                    for member in members:
-                        path, filename = os.path.split(member.name)
-                        if path == '':
-                            yield member, filename
-
-                with tarfile.open(file, 'r:gz') as fh:
-                    members = []
-                    for member, filename in inspect(fh):
-                        members.append(member)
-                        result.append(
-                            os.path.join(working_directory, filename))
-                    fh.extractall(
-                        path=working_directory, members=members)
-                os.remove(file)
+                callback=progress,
+                segments=segments,
+                cache=cache,
+                verify=verify,
+                metrics=metrics,
+                manifest=manifest)
+
+        def link_duplicate(file, metrics):
+            local_path = os.path.join(working_directory, file)
+            algorithm, checksum = repository.digest(file)
+            if force or not manifest.verify(
+                    file, algorithm, checksum,
+                    size=repository.size(file), mode=verify):
+                metrics.source = 'duplicate'
+                materialize(
+                    os.path.join(working_directory, duplicates[file]),
+                    local_path)
+                manifest.record(file, algorithm, checksum)
+            return local_path
+
+        result = []
+        # the manifest is written once for all files of this call
+        with manifest.batch(), (
+                ExitStack() if bars is None else bars.context()):
+            if max_workers > 1 and len(stack) > 1:
+                # all workers share the repository's session
+                repository._get_connection(pool_maxsize=max_workers)
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    files = list(executor.map(
+                        download, stack, callbacks, metrics))
             else:
-                result.append(file)
+                files = list(map(download, stack, callbacks, metrics))
+            for item, file, measured in zip(stack, files, metrics):
+                if item['file'] in duplicates:
+                    file = link_duplicate(item['file'], measured)
+                if not item['unpack']:
+                    result.append(file)
+                    continue
+                if not isinstance(file, list):
+                    _, metadata = repository.lookup(item['file'])
+                    with measured.phase('extract'):
+                        archive, file = file, extract_container(
+                            file, working_directory,
+                            blocks=metadata.get('blocks'),
+                            members=repository.members(item['file']),
+                            checksums=checksums)
+                    os.remove(archive)
+                # only digests computed from the extracted data are trusted
+                names = [os.path.basename(path) for path in file]
+                computed = {
+                    name: checksums[name]
+                    for name in names if name in checksums}
+                if computed:
+                    manifest.record_all(computed)
+                result += file
+    except BaseException as e:
+        summary.finish(error=e)
+        repository.notify(summary)
+        raise
+    summary.finish()
+    repository.notify(summary)
 
     if len(result) == 0:
         raise LoadError(remote_filename, 'this should not have happend!')
     elif len(result) == 1:
         return result[0]
     return result
+
+
+def load(
+        remote_filename, working_directory='.', repository=None, **kwargs):
+    """Fetch .npy/.npz files and return their arrays memory-mapped.
+
+    Arrays are mapped read-only from the local files, so that several
+    processes share the same pages instead of holding their own copies.
+    Compressed .npz members are unpacked once into .npy files.
+
+    Arguments:
+        remote_filename (str): name of the file in the repository
+        working_directory (str): directory where the file should be saved
+        repository (Repository): repository object
+
+    All further keyword arguments are passed to fetch(). Returns an array
+    for .npy files and a dict of arrays for .npz files (a list thereof if
+    several files match).
+    """
+    from .arrays import ARRAY_SUFFIXES, map_file
+    if repository is None:
+        repository = get_default_repository()
+    if not isinstance(repository, Repository):
+        raise TypeError(f'received {type(repository)} instead of Repository')
+    for item in repository.stack(remote_filename):
+        if not item['unpack'] and not item['file'].endswith(ARRAY_SUFFIXES):
+            raise LoadError(item['file'], 'not an .npy/.npz file, use fetch')
+    files = fetch(
+        remote_filename, working_directory=working_directory,
+        repository=repository, **kwargs)
+    if not isinstance(files, list):
+        return map_file(files)
+    return [
+        map_file(file) for file in files if file.endswith(ARRAY_SUFFIXES)]
+
+
+def open_npz(remote_filename, repository=None, cache_directory=None):
+    """Open an .npz file in the repository without downloading it.
+
+    Arguments:
+        remote_filename (str): name of the .npz file in the repository
+        repository (Repository): repository object
+        cache_directory (str): where accessed arrays are stored, defaults
+            to $XDG_CACHE_HOME/mdshare/npz
+
+    Returns a RemoteNpz object which lists the arrays (keys(), shapes,
+    dtypes) and fetches only the bytes of the arrays which are accessed.
+    """
+    from .arrays import RemoteNpz
+    if repository is None:
+        repository = get_default_repository()
+    if not isinstance(repository, Repository):
+        raise TypeError(f'received {type(repository)} instead of Repository')
+    location, _ = repository.lookup(remote_filename)
+    if location != 'index' or not remote_filename.endswith('.npz'):
+        raise LoadError(remote_filename, 'not an .npz file')
+    return RemoteNpz(
+        remote_filename, repository, cache_directory=cache_directory)
+
+
+def fetch_stream(remote_filename, repository=None, max_attempts=3):
+    """Open a file in the repository as a stream without saving it.
+
+    The returned file object supports read() and iteration over chunks.
+    Its data is hashed while being read and reading to the end raises a
+    LoadError if the checksum does not match, so the data must not be
+    trusted before the end has been reached.
+
+    Arguments:
+        remote_filename (str): name of the file in the repository
+        repository (Repository): repository object
+        max_attempts (int): number of attempts to (re)open the transfer
+    """
+    if repository is None:
+        repository = get_default_repository()
+    if not isinstance(repository, Repository):
+        raise TypeError(f'received {type(repository)} instead of Repository')
+    return VerifiedStream(
+        repository, remote_filename, max_attempts=max_attempts)
+
+
+def fetch_bytes(remote_filename, repository=None, max_attempts=3):
+    """Download a (small) file into memory.
+
+    Arguments:
+        remote_filename (str): name of the file in the repository
+        repository (Repository): repository object
+        max_attempts (int): number of attempts to (re)open the transfer
+
+    Returns an io.BytesIO object with the verified content; use its
+    getbuffer() method for a memoryview without copying.
+    """
+    with fetch_stream(
+            remote_filename, repository=repository,
+            max_attempts=max_attempts) as stream:
+        return BytesIO(b''.join(stream))
+
+
+async def afetch(remote_filename, executor=None, **kwargs):
+    """Coroutine version of fetch() which does not block the event loop.
+
+    Cancelling the coroutine stops the download after its current chunk.
+    With the default executor, concurrent calls are only bounded by the
+    executor's worker count; use afetch_many() or pass an executor to
+    limit the number of simultaneous downloads.
+
+    Arguments:
+        remote_filename (str): name of the file in the repository
+        executor (concurrent.futures.Executor): executor to run the
+            download in, defaults to the event loop's default executor
+
+    All further keyword arguments are passed to fetch().
+    """
+    import asyncio
+    stop = kwargs.setdefault('stop', Event())
+    loop = asyncio.get_event_loop()
+    try:
+        return await loop.run_in_executor(
+            executor, partial(fetch, remote_filename, **kwargs))
+    except asyncio.CancelledError:
+        stop.set()
+        raise
+
+
+async def afetch_many(
+        remote_filenames, working_directory='.', repository=None,
+        max_concurrency=4, **kwargs):
+    """Fetch several files/patterns with bounded concurrency.
+
+    Files matched by more than one pattern are downloaded only once. If
+    a download fails or the coroutine is cancelled, queued downloads are
+    dropped and running ones stop after their current chunk.
+
+    Arguments:
+        remote_filenames (list of str): names of files in the repository
+        working_directory (str): directory where the files should be saved
+        repository (Repository): repository object
+        max_concurrency (int): number of files to download concurrently
+
+    All further keyword arguments are passed to fetch(). Returns one
+    fetch() result per entry of remote_filenames.
+    """
+    if repository is None:
+        repository = get_default_repository()
+    if not isinstance(repository, Repository):
+        raise TypeError(f'received {type(repository)} instead of Repository')
+    if max_concurrency < 1:
+        raise ValueError('max_concurrency must be a positive integer')
+    if working_directory is None:
+        working_directory = mkdtemp()
+    stacks = []
+    for remote_filename in remote_filenames:
+        stack = [item['file'] for item in repository.stack(remote_filename)]
+        if len(stack) == 0:
+            raise LoadError(remote_filename, 'no match in repository')
+        stacks.append(stack)
+    files = list(dict.fromkeys(file for stack in stacks for file in stack))
+    import asyncio
+    stop = kwargs.setdefault('stop', Event())
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    futures = [
+        executor.submit(
+            fetch,
+            file,
+            working_directory=working_directory,
+            repository=repository,
+            **kwargs)
+        for file in files]
+    try:
+        results = await asyncio.gather(*(
+            asyncio.wrap_future(future) for future in futures))
+    finally:
+        if not all(future.done() for future in futures):
+            stop.set()
+            for future in futures:
+                future.cancel()
+        executor.shutdown(wait=False)
+    results = dict(zip(files, results))
+    output = []
+    for stack in stacks:
+        local_files = []
+        for file in stack:
+            result = results[file]
+            local_files += result if isinstance(result, list) else [result]
+        output.append(local_files[0] if len(local_files) == 1 else local_files)
+    return output
@@ -0,0 +1,336 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Memory-mapped access to .npy and .npz files; requires numpy."""
+
+import os
+import shutil
+import logging
+import struct
+import zipfile
+from .bandwidth import throttle
+
+ARRAY_SUFFIXES = ('.npy', '.npz')
+# directory next to an .npz file which holds its unpacked members
+UNPACKED_DIRECTORY = '.mdshare-npy'
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+
+def map_array(path, fh, offset):
+    """Memory-map an array stored in .npy format inside a file.
+
+    Arrays which cannot be mapped (object dtypes, empty arrays) are read
+    into memory instead.
+
+    Arguments:
+        path (str): path of the file
+        fh (file object): the same file opened for reading
+        offset (int): position of the .npy data in the file
+    """
+    import numpy as np
+    from numpy.lib import format
+    fh.seek(offset)
+    version = format.read_magic(fh)
+    if version == (1, 0):
+        shape, fortran_order, dtype = format.read_array_header_1_0(fh)
+    else:
+        shape, fortran_order, dtype = format.read_array_header_2_0(fh)
+    if dtype.hasobject or 0 in shape:
+        fh.seek(offset)
+        return format.read_array(fh, allow_pickle=False)
+    return np.memmap(
+        path, dtype=dtype, mode='r', shape=shape,
+        order='F' if fortran_order else 'C', offset=fh.tell())
+
+
+def map_npy(path):
+    """Memory-map an .npy file."""
+    with open(path, 'rb') as fh:
+        return map_array(path, fh, 0)
+
+
+def unpack_member(archive, info, directory):
+    """Decompress an archive member into a file, unless this happened
+    before, and return the file's path."""
+    path = os.path.join(directory, info.filename)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with archive.open(info) as source, open(tmp, 'wb') as target:
+        shutil.copyfileobj(source, target, 2**20)
+    os.replace(tmp, path)
+    return path
+
+
+def remove_unpacked(path):
+    """Remove the unpacked members of all versions of an .npz file."""
+    directory, name = os.path.split(path)
+    directory = os.path.join(directory, UNPACKED_DIRECTORY)
+    if not os.path.isdir(directory):
+        return
+    for entry in os.listdir(directory):
+        if entry.rsplit('-', 2)[0] == name:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def map_npz(path):
+    """Memory-map all arrays of an .npz file.
+
+    Stored (uncompressed) members are mapped at their offset inside the
+    archive; compressed members are unpacked once into .npy files next to
+    the archive and mapped from there.
+
+    Arguments:
+        path (str): path of the .npz file
+
+    Returns a dict of arrays keyed by name.
+    """
+    stat = os.stat(path)
+    directory, name = os.path.split(path)
+    unpacked = os.path.join(
+        directory, UNPACKED_DIRECTORY,
+        f'{name}-{stat.st_size}-{stat.st_mtime_ns}')
+    arrays = dict()
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as fh:
+        for info in archive.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            key = info.filename[:-4]
+            if info.compress_type != zipfile.ZIP_STORED:
+                if not os.path.isdir(unpacked):
+                    remove_unpacked(path)
+                arrays[key] = map_npy(unpack_member(archive, info, unpacked))
+                continue
+            fh.seek(info.header_offset)
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(
+                fh.read(ZIP_LOCAL_HEADER.size))
+            if signature != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f'{path}: bad header of {key}')
+            arrays[key] = map_array(path, fh, (
+                info.header_offset + ZIP_LOCAL_HEADER.size
+                + name_length + extra_length))
+    return arrays
+
+
+def map_file(path):
+    """Memory-map an .npy file or all arrays of an .npz file."""
+    if path.endswith('.npz'):
+        return map_npz(path)
+    return map_npy(path)
+
+
+class RemoteFile(object):
+    """Seekable, read-only file object over a repository file which
+    fetches the bytes being read via HTTP Range requests.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the file in the repository
+        block_size (int): minimum number of bytes per request
+    """
+    def __init__(self, repository, file, block_size=65536):
+        self.repository = repository
+        self.file = file
+        self.size = repository.size(file)
+        self.block_size = block_size
+        self.requests = 0
+        self._position = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self._window = None
+
+    def _get(self, start, stop):
+        # mirrors which ignore the Range header are treated as failed
+        from requests import RequestException
+        from .utils import LoadError
+        connection = self.repository._get_connection()
+        mirrors = self.repository.mirrors_for(self.file)
+        error = None
+        for mirror in mirrors.ranked(connection):
+            try:
+                response = connection.get(
+                    self.repository.url_for(self.file, mirror=mirror),
+                    headers={'Range': f'bytes={start}-{stop - 1}'})
+                response.raise_for_status()
+            except RequestException as e:
+                logging.debug(f'<{mirror}> cannot provide {self.file}: {e}')
+                mirrors.failed(mirror)
+                error = e
+                continue
+            if response.status_code == 206:
+                self.requests += 1
+                return response
+            response.close()
+            logging.debug(f'<{mirror}> ignores Range for {self.file}')
+            mirrors.failed(mirror)
+            error = LoadError(
+                self.file, 'server does not support byte ranges')
+        raise error
+
+    def fetch(self, start, stop):
+        """Read a byte range into the buffer with a single request."""
+        response = self._get(start, stop)
+        self._buffer = b''.join(
+            throttle(response.iter_content(self.block_size)))
+        self._buffer_start = start
+
+    def stream(self, start, stop):
+        """Serve sequential reads of a byte range from a single streamed
+        request instead of one request per read."""
+        response = self._get(start, stop)
+        self._window = [
+            start, throttle(response.iter_content(self.block_size))]
+
+    def _read_chunk(self, stop):
+        position = self._position
+        offset = position - self._buffer_start
+        if 0 <= offset < len(self._buffer):
+            return self._buffer[offset:offset + stop - position]
+        if self._window is not None and self._window[0] == position:
+            data = next(self._window[1], b'')
+            if data:
+                self._window[0] += len(data)
+                self._buffer, self._buffer_start = data, position
+                return data[:stop - position]
+            self._window = None
+        self.fetch(
+            position, min(self.size, max(stop, position + self.block_size)))
+        return self._buffer[:stop - position]
+
+    def read(self, size=-1):
+        stop = self.size if size < 0 else min(
+            self.size, self._position + size)
+        chunks = []
+        while self._position < stop:
+            data = self._read_chunk(stop)
+            if not data:
+                break
+            chunks.append(data)
+            self._position += len(data)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._window = None
+        self._buffer = b''
+
+
+class RemoteNpz(object):
+    """Lazy view of an .npz file in a repository.
+
+    Only the zip central directory is downloaded on construction; array
+    headers and data are fetched via byte ranges when accessed. Accessed
+    arrays are stored as .npy files in a local cache (keyed by the
+    archive's hash) and returned memory-mapped; their CRC is checked
+    while they are fetched.
+
+    Arguments:
+        file (str): name of the .npz file in the repository
+        repository (Repository): repository object
+        cache_directory (str): where fetched arrays are stored, defaults
+            to $XDG_CACHE_HOME/mdshare/npz
+    """
+    # the end of the archive holds its central directory
+    tail_size = 65536
+
+    def __init__(self, file, repository, cache_directory=None):
+        from .cache import default_cache_path
+        self.file = file
+        self.repository = repository
+        if cache_directory is None:
+            cache_directory = os.path.join(default_cache_path(), 'npz')
+        self.cache_directory = os.path.join(
+            cache_directory, repository.digest(file)[1])
+        self._remote = RemoteFile(repository, file)
+        self._remote.fetch(
+            max(0, self._remote.size - self.tail_size), self._remote.size)
+        self._archive = zipfile.ZipFile(self._remote)
+        self._members = {
+            info.filename[:-4]: info for info in self._archive.infolist()
+            if info.filename.endswith('.npy')}
+        self._headers = dict()
+
+    def keys(self):
+        return list(self._members)
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, key):
+        return key in self._members
+
+    def _header(self, key):
+        if key not in self._headers:
+            from numpy.lib import format
+            with self._archive.open(self._members[key]) as fh:
+                version = format.read_magic(fh)
+                if version == (1, 0):
+                    header = format.read_array_header_1_0(fh)
+                else:
+                    header = format.read_array_header_2_0(fh)
+            self._headers[key] = header
+        return self._headers[key]
+
+    @property
+    def shapes(self):
+        """Shapes of all arrays; fetches one header per array"""
+        return {key: self._header(key)[0] for key in self._members}
+
+    @property
+    def dtypes(self):
+        """Data types of all arrays; fetches one header per array"""
+        return {key: self._header(key)[2] for key in self._members}
+
+    def __getitem__(self, key):
+        info = self._members[key]
+        path = os.path.join(self.cache_directory, info.filename)
+        if not os.path.exists(path):
+            # the member's local header has variable-length fields
+            self._remote.stream(info.header_offset, min(
+                self._remote.size,
+                info.header_offset + info.compress_size + 2 * 65536))
+            unpack_member(self._archive, info, self.cache_directory)
+        return map_npy(path)
+
+    def close(self):
+        self._archive.close()
+        self._remote.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
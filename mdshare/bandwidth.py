@@ -0,0 +1,177 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import struct
+import logging
+from collections import deque
+from tempfile import gettempdir
+from threading import Condition, Lock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# bucket state in a coordination file: tokens, timestamp
+STATE = struct.Struct('<dd')
+
+
+def default_coordination_file():
+    """Return the file which processes on this host share by default."""
+    return os.path.join(gettempdir(), 'mdshare-bandwidth')
+
+
+class RateLimiter(object):
+    """Token bucket which caps the combined throughput of all downloads.
+
+    Downloads are served in the order of their requests, so concurrent
+    downloads get a fair share of the bandwidth. The bucket may live in a
+    coordination file shared by all processes on a host; processes then
+    reserve tokens in quanta of 1/20 s to keep the file locking cheap.
+
+    Arguments:
+        rate (float): bytes per second
+        burst (float): bucket capacity in bytes, defaults to 1/4 s of rate
+        path (str): coordination file shared with other processes, None
+            for a bucket within this process
+    """
+    def __init__(self, rate, burst=None, path=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.burst = float(self.rate / 4 if burst is None else burst)
+        self.path = path
+        if path is not None and fcntl is None:
+            logging.debug('no fcntl ... bandwidth limit is per process')
+            self.path = None
+        self.quantum = self.rate / 20 if self.path is not None else 0.0
+        self._tokens = self.burst
+        self._timestamp = time.time()
+        self._reserve = 0.0
+        self._queue = deque()
+        self._condition = Condition(Lock())
+
+    def _refill(self, tokens, timestamp, amount):
+        now = time.time()
+        tokens = min(
+            self.burst,
+            tokens + max(0.0, now - timestamp) * self.rate) - amount
+        return tokens, now
+
+    def _take(self, amount):
+        """Remove tokens from the bucket; return the time to wait."""
+        if self.path is not None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError as e:
+                logging.debug(f'cannot open {self.path} ... per process: {e}')
+                self.path = None
+        if self.path is None:
+            self._tokens, self._timestamp = self._refill(
+                self._tokens, self._timestamp, amount)
+            return max(0.0, -self._tokens / self.rate)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, STATE.size, 0)
+            if len(data) == STATE.size:
+                state = STATE.unpack(data)
+            else:
+                state = self.burst, time.time()
+            tokens, now = self._refill(*state, amount)
+            os.pwrite(fd, STATE.pack(tokens, now), 0)
+        finally:
+            os.close(fd)
+        return max(0.0, -tokens / self.rate)
+
+    def acquire(self, nbytes):
+        """Block until nbytes may be transferred."""
+        with self._condition:
+            ticket = object()
+            self._queue.append(ticket)
+            while self._queue[0] is not ticket:
+                self._condition.wait()
+        try:
+            if self._reserve >= nbytes:
+                self._reserve -= nbytes
+                return
+            amount = max(nbytes - self._reserve, self.quantum)
+            self._reserve += amount - nbytes
+            wait = self._take(amount)
+            if wait > 0:
+                time.sleep(wait)
+        finally:
+            with self._condition:
+                self._queue.popleft()
+                self._condition.notify_all()
+
+    def throttle(self, chunks):
+        """Pass the chunks of a stream on at the limited rate."""
+        for data in chunks:
+            self.acquire(len(data))
+            yield data
+
+
+_limiter = None
+_configured = False
+
+
+def set_bandwidth_limit(rate, burst=None, shared=False):
+    """Cap the combined download rate of this process.
+
+    Arguments:
+        rate (int or str): bytes per second (e.g., 50e6 or '50 MB'),
+            None to remove the limit
+        burst (int): bucket capacity in bytes, defaults to 1/4 s of rate
+        shared (bool or str): share the limit with all processes on this
+            host via a coordination file; True for the default file
+    """
+    global _limiter, _configured
+    if isinstance(rate, str):
+        from humanfriendly import parse_size
+        rate = parse_size(rate)
+    path = default_coordination_file() if shared is True else (
+        shared or None)
+    _limiter = None if rate is None else RateLimiter(
+        rate, burst=burst, path=path)
+    _configured = True
+    return _limiter
+
+
+def get_bandwidth_limiter():
+    """Return the limiter of this process or None.
+
+    Unless set_bandwidth_limit() was called, the limit is read from the
+    MDSHARE_BANDWIDTH environment variable (e.g., '50 MB'); it is shared
+    with all processes on the host via the file given in
+    MDSHARE_BANDWIDTH_FILE or a default coordination file.
+    """
+    if not _configured:
+        rate = os.environ.get('MDSHARE_BANDWIDTH')
+        set_bandwidth_limit(
+            rate or None,
+            shared=os.environ.get('MDSHARE_BANDWIDTH_FILE') or True)
+    return _limiter
+
+
+def throttle(chunks):
+    """Apply the process's bandwidth limit, if any, to a stream of chunks."""
+    limiter = get_bandwidth_limiter()
+    if limiter is None:
+        return chunks
+    return limiter.throttle(chunks)
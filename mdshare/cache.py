@@ -0,0 +1,263 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import logging
+from .utils import attempt_to_download_file
+from .locking import FileLock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl request to clone a file's extents (Linux: btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# suffix of the sidecar files recording when an entry was last used
+USED_SUFFIX = '.used'
+
+
+def default_cache_path():
+    """Return the XDG cache location for mdshare."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mdshare')
+
+
+def reflink(source, target):
+    """Create a copy-on-write clone of source at target."""
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+LINKERS = dict(
+    reflink=reflink,
+    hardlink=os.link,
+    symlink=lambda source, target: os.symlink(
+        os.path.abspath(source), target),
+    copy=shutil.copyfile)
+
+
+def materialize(source, target, link='auto'):
+    """Make a cached file available at the target path.
+
+    Arguments:
+        source (str): path of the cached file
+        target (str): path where the file should appear
+        link (str): reflink, hardlink, symlink, copy, or auto to try
+            them in that order
+    """
+    if link == 'auto':
+        links = ('reflink', 'hardlink', 'symlink', 'copy')
+    elif link in LINKERS:
+        links = (link,)
+    else:
+        raise ValueError(f'unsupported link mode: {link}')
+    if os.path.lexists(target):
+        os.remove(target)
+    for link in links:
+        try:
+            LINKERS[link](source, target)
+        except OSError as e:
+            logging.debug(f'cannot {link} {source} to {target}: {e}')
+            if len(links) == 1:
+                raise
+            continue
+        logging.debug(f'{link} {source} to {target}')
+        return link
+    raise OSError(f'cannot materialize {source} at {target}')
+
+
+class Cache(object):
+    """Persistent, content-addressed store for downloaded files.
+
+    Files are stored under their catalogue hash and made available in a
+    working directory via materialize(). The least recently used files
+    are evicted once the cache exceeds max_size bytes.
+
+    Arguments:
+        path (str): cache directory, defaults to $XDG_CACHE_HOME/mdshare
+        max_size (int): byte budget, None for no limit
+        link (str): how files are materialized, see materialize()
+    """
+    def __init__(self, path=None, max_size=None, link='auto'):
+        if link != 'auto' and link not in LINKERS:
+            raise ValueError(f'unsupported link mode: {link}')
+        self.path = default_cache_path() if path is None else path
+        self.max_size = max_size
+        self.link = link
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.isfile(self._entry_path(key))
+
+    def _touch(self, key):
+        # usage times live in a sidecar file: entries are read-only and
+        # may be hardlinked into working directories, so their own
+        # metadata must not change on a hit
+        path = self._entry_path(key) + USED_SUFFIX
+        try:
+            with open(path, 'a'):
+                pass
+            os.utime(path)
+        except OSError as error:
+            logging.debug(f'cannot record use of {key}: {error}')
+
+    def get(self, key):
+        """Return the path of a cached file and mark it as used."""
+        path = self._entry_path(key)
+        if not os.path.isfile(path):
+            return None
+        self._touch(key)
+        return path
+
+    def entries(self):
+        """Return all cached files, least recently used first."""
+        entries = []
+        for directory in os.listdir(self.path):
+            directory = os.path.join(self.path, directory)
+            # entries live in two-character prefix directories
+            if len(os.path.basename(directory)) != 2 or not os.path.isdir(
+                    directory):
+                continue
+            for key in os.listdir(directory):
+                # skip partial downloads, locks and usage sidecars
+                if '.' in key:
+                    continue
+                path = os.path.join(directory, key)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                try:
+                    last_used = os.stat(path + USED_SUFFIX).st_mtime
+                except OSError:
+                    last_used = stat.st_mtime
+                entries.append(dict(
+                    hash=key, path=path,
+                    size=stat.st_size, last_used=last_used))
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    def size(self):
+        """Return the total size of all cached files in bytes."""
+        return sum(entry['size'] for entry in self.entries())
+
+    def prune(self, max_size=None, keep=()):
+        """Evict least recently used files until the budget is met.
+
+        Arguments:
+            max_size (int): byte budget, defaults to the cache's max_size
+            keep (iterable): hashes which must not be evicted
+
+        Returns the list of evicted hashes.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry['hash'] in keep:
+                continue
+            for path in (entry['path'], entry['path'] + USED_SUFFIX):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= entry['size']
+            evicted.append(entry['hash'])
+            logging.debug(f'evicted {entry["hash"]} from {self.path}')
+        return evicted
+
+    def clear(self):
+        """Remove all cached files."""
+        return self.prune(max_size=0)
+
+    def retrieve(
+            self, repository, file, local_path,
+            max_attempts=3, force=False, callback=None, segments=1,
+            metrics=None):
+        """Materialize a repository file, downloading it into the cache
+        if necessary.
+
+        Arguments:
+            repository (Repository): repository object
+            file (str): name of the file in the repository
+            local_path (str): local path where the file should appear
+            max_attempts (int): number of download attempts
+            force (boolean): enforce download even if file is cached
+            callback (callable): callback function
+            segments (int): number of concurrent byte ranges for large files
+            metrics (FileMetrics): records the cache hit or miss and the
+                phases of the download
+        """
+        key = repository.hash(file)
+        path = None if force else self.get(key)
+        if path is None:
+            path = self._entry_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # processes sharing the cache download each entry once
+            with FileLock(path) as lock:
+                if (force and not lock.waited) or self.get(key) is None:
+                    logging.debug(f'cache miss for {file} ({key})')
+                    if metrics is not None:
+                        metrics.cache = 'miss'
+                    attempt_to_download_file(
+                        repository, file, path,
+                        max_attempts=max_attempts,
+                        callback=callback,
+                        segments=segments,
+                        metrics=metrics)
+                    # linked copies share the cached data, so guard
+                    # against writes
+                    os.chmod(path, 0o444)
+                    self._touch(key)
+                    self.prune(keep=(key,))
+                elif metrics is not None:
+                    metrics.cache, metrics.source = 'hit', 'cache'
+        else:
+            logging.debug(f'cache hit for {file} ({key})')
+            if metrics is not None:
+                metrics.cache, metrics.source = 'hit', 'cache'
+        materialize(path, local_path, link=self.link)
+        return local_path
+
+    def __str__(self):
+        from humanfriendly import format_size
+        entries = self.entries()
+        string = f'Cache: {self.path}\n'
+        string += f'Files: {len(entries)}\n'
+        string += f'Size:  {format_size(sum(e["size"] for e in entries))}'
+        if self.max_size is not None:
+            string += f' of {format_size(self.max_size)}'
+        return string
@@ -0,0 +1,224 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import errno
+import socket
+import logging
+from threading import Event, Thread
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# flock() errors of file systems without (working) support for it
+NO_FLOCK = (errno.ENOLCK, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+
+
+def holder():
+    """Return the identity written into lock files."""
+    return f'{socket.gethostname()} {os.getpid()}'
+
+
+def is_alive(pid):
+    """Check whether a process on this host exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class FileLock(object):
+    """Exclusive lock which lets one process at a time work on a path.
+
+    The lock is held on path + '.lock' via fcntl.flock(), which the
+    kernel releases when the holder dies, so a crashed download never
+    blocks the others. On file systems without flock() (and without
+    fcntl), the lock file itself is the lock: it is created exclusively,
+    names its host and process, and is touched every stale/4 seconds.
+    Such a lock is considered stale and broken if its process no longer
+    exists on this host or it was not touched for stale seconds.
+
+    Arguments:
+        path (str): path to be protected
+        timeout (float): seconds to wait for the lock, None for no limit
+        stale (float): seconds after which an untouched lock file is
+            considered stale
+        poll (float): maximum seconds between two attempts
+
+    Attributes:
+        waited (bool): whether another process held the lock before;
+            it may have done the work in the meantime
+    """
+    def __init__(self, path, timeout=None, stale=60.0, poll=1.0):
+        self.path = f'{path}.lock'
+        self.timeout = timeout
+        self.stale = stale
+        self.poll = poll
+        self.waited = False
+        self._fd = None
+        self._heartbeat = None
+        self._stop = Event()
+
+    def _deadline_passed(self, deadline):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f'cannot acquire {self.path}')
+
+    def _sleep(self, delay):
+        time.sleep(delay)
+        return min(self.poll, 2 * delay)
+
+    def acquire(self):
+        self.waited = False
+        deadline = None if self.timeout is None else (
+            time.monotonic() + self.timeout)
+        if fcntl is not None:
+            try:
+                return self._acquire_flock(deadline)
+            except OSError as e:
+                if e.errno not in NO_FLOCK:
+                    raise
+                logging.debug(f'no flock() for {self.path}: {e}')
+        return self._acquire_exclusive(deadline)
+
+    def _acquire_flock(self, deadline):
+        delay = 0.01
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if not self.waited:
+                        logging.debug(f'waiting for {self.path}')
+                    self.waited = True
+                    if self.timeout is None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    else:
+                        os.close(fd)
+                        fd = None
+                        self._deadline_passed(deadline)
+                        delay = self._sleep(delay)
+                        continue
+                # the previous holder may have removed the file meanwhile
+                try:
+                    current = os.path.samestat(
+                        os.fstat(fd), os.stat(self.path))
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    os.ftruncate(fd, 0)
+                    os.write(fd, holder().encode())
+                    self._fd, fd = fd, None
+                    return self
+                self.waited = True
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def _acquire_exclusive(self, deadline):
+        delay = 0.01
+        while True:
+            try:
+                fd = os.open(
+                    self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            except FileExistsError:
+                if self._break_stale():
+                    continue
+                if not self.waited:
+                    logging.debug(f'waiting for {self.path}')
+                self.waited = True
+                self._deadline_passed(deadline)
+                delay = self._sleep(delay)
+                continue
+            try:
+                os.write(fd, holder().encode())
+            finally:
+                os.close(fd)
+            self._stop.clear()
+            self._heartbeat = Thread(target=self._touch, daemon=True)
+            self._heartbeat.start()
+            return self
+
+    def _touch(self):
+        while not self._stop.wait(self.stale / 4):
+            try:
+                os.utime(self.path)
+            except OSError as e:
+                logging.debug(f'cannot touch {self.path}: {e}')
+
+    def _break_stale(self):
+        """Remove a lock file whose holder is gone; return whether the
+        lock file is gone."""
+        try:
+            stat = os.stat(self.path)
+            with open(self.path, 'r') as fh:
+                host, pid = (fh.read().split() + ['', ''])[:2]
+        except FileNotFoundError:
+            return True
+        if time.time() - stat.st_mtime > self.stale:
+            reason = f'untouched for {self.stale:.0f}s'
+        elif os.name == 'posix' and host == socket.gethostname() and (
+                pid.isdigit() and not is_alive(int(pid))):
+            reason = f'process {pid} is gone'
+        else:
+            return False
+        # move the lock file aside first, so only one process breaks it
+        aside = f'{self.path}.{socket.gethostname()}.{os.getpid()}.stale'
+        try:
+            os.rename(self.path, aside)
+        except FileNotFoundError:
+            return True
+        if os.stat(aside).st_ino != stat.st_ino:
+            # another process broke the lock and took it meanwhile
+            try:
+                os.link(aside, self.path)
+            except OSError:
+                pass
+        else:
+            logging.warning(f'breaking stale lock {self.path}: {reason}')
+        os.remove(aside)
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            # remove the file while holding the lock, see _acquire_flock()
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        elif self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
@@ -0,0 +1,189 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import logging
+from contextlib import contextmanager
+from threading import Lock
+from .utils import file_hash, select_digest
+from .locking import FileLock
+
+
+VERIFY_MODES = ('none', 'fast', 'full')
+_lock = Lock()
+
+
+def stat_signature(path):
+    """Return (size, mtime_ns, inode) of a file."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class Manifest(object):
+    """Record of verified files in a working directory.
+
+    Each entry maps a filename to its verified hash together with the
+    file's size, mtime, and inode, which allows checking a file in O(1)
+    as long as it has not been touched since. The manifest is parsed
+    only when the file changed, and records made within batch() are
+    written at once.
+
+    Arguments:
+        directory (str): directory holding the files and the manifest
+    """
+    filename = '.mdshare-manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+        self._data, self._signature = dict(), None
+        self._pending = None
+        self._pending_lock = Lock()
+
+    def load(self):
+        """Return the recorded entries; the file is only parsed on changes."""
+        try:
+            signature = stat_signature(self.path)
+        except OSError:
+            signature = None
+        if signature != self._signature:
+            try:
+                with open(self.path, 'r') as fh:
+                    data = json.load(fh)
+            except (FileNotFoundError, ValueError):
+                data = dict()
+            self._data, self._signature = data, signature
+        return self._data
+
+    def _lookup(self, filename):
+        with self._pending_lock:
+            if self._pending is not None and filename in self._pending:
+                return self._pending[filename]
+        return self.load().get(filename)
+
+    def _update(self, entries=None, prune=False):
+        # processes sharing the directory must not drop each other's entries
+        try:
+            with _lock, FileLock(self.path):
+                data = dict(self.load())
+                data.update(entries or dict())
+                if prune:
+                    data = {
+                        key: value for key, value in data.items()
+                        if os.path.exists(os.path.join(self.directory, key))}
+                tmp = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp, 'w') as fh:
+                    # dumps() uses the C encoder, dump() does not
+                    fh.write(json.dumps(data))
+                os.replace(tmp, self.path)
+                self._data, self._signature = data, stat_signature(self.path)
+        except OSError as e:
+            # the manifest only saves work, e.g., on read-only directories
+            logging.debug(f'cannot update {self.path}: {e}')
+
+    def record(self, filename, algorithm, checksum):
+        """Store the verified hash and current stat of a file."""
+        self.record_all({filename: (algorithm, checksum)})
+
+    def record_all(self, checksums):
+        """Store verified hashes of several files.
+
+        Arguments:
+            checksums (dict): filename -> (algorithm, hexdigest)
+        """
+        entries = {
+            filename: dict(
+                algorithm=algorithm, hash=checksum,
+                stat=stat_signature(os.path.join(self.directory, filename)))
+            for filename, (algorithm, checksum) in checksums.items()}
+        with self._pending_lock:
+            if self._pending is not None:
+                self._pending.update(entries)
+                return
+        self._update(entries)
+
+    @contextmanager
+    def batch(self):
+        """Collect the records made within the context and write them at
+        once when it is left."""
+        with self._pending_lock:
+            outer = self._pending is None
+            if outer:
+                self._pending = dict()
+        try:
+            yield self
+        finally:
+            if outer:
+                with self._pending_lock:
+                    entries, self._pending = self._pending, None
+                if entries:
+                    self._update(entries)
+
+    def prune(self):
+        """Drop the entries of files which no longer exist."""
+        self._update(prune=True)
+
+    def verify(self, filename, algorithm, expected, size=None, mode='fast'):
+        """Check whether a local file has the expected hash.
+
+        Arguments:
+            filename (str): name of the file in the directory
+            algorithm (str): name of the hashlib algorithm
+            expected (str): expected hexdigest
+            size (int): expected size in bytes, if known
+            mode (str): 'none' only checks existence, 'fast' trusts a
+                matching manifest entry, 'full' always re-hashes
+        """
+        if mode not in VERIFY_MODES:
+            raise ValueError(f'unsupported verify mode: {mode}')
+        path = os.path.join(self.directory, filename)
+        try:
+            signature = stat_signature(path)
+        except FileNotFoundError:
+            return False
+        if mode == 'none':
+            return True
+        if size is not None and signature[0] != size:
+            logging.debug(f'{path} has size {signature[0]} instead of {size}')
+            return False
+        if mode == 'fast':
+            entry = self._lookup(filename)
+            if entry is not None and entry['stat'] == signature and (
+                    entry['algorithm'] == algorithm):
+                return entry['hash'] == expected
+        checksum = file_hash(path, algorithm=algorithm)
+        if checksum != expected:
+            logging.debug(f'{path} has {algorithm} {checksum}')
+            return False
+        self.record(filename, algorithm, checksum)
+        return True
+
+    def verify_all(self, entries, mode='fast'):
+        """Check several files against their catalogue entries.
+
+        Arguments:
+            entries (dict): filename -> catalogue entry with size and digest
+            mode (str): see verify()
+        """
+        for filename, metadata in entries.items():
+            algorithm, expected = select_digest(metadata)
+            if not self.verify(
+                    filename, algorithm, expected,
+                    size=metadata['size'], mode=mode):
+                return False
+        return True
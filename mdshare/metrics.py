@@ -0,0 +1,388 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-phase timings of fetch() calls and exporters for them.
+
+Each file of a fetch() call gets a FileMetrics object with the seconds
+spent in each phase:
+
+    connect     until the response headers arrive
+    first_byte  from the response headers to the first byte of data
+    transfer    from the first to the last byte (or a local copy/link)
+    hash        verifying data which was not hashed while it arrived
+    extract     unpacking a downloaded container
+
+Containers which are extracted while they are downloaded spend their
+extraction in transfer. The catalogue lookup is recorded once per call
+in FetchSummary.phases. Observers registered with
+Repository.add_observer() receive the FetchSummary of every call.
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+from contextlib import contextmanager
+from threading import Lock
+
+PHASES = ('lookup', 'connect', 'first_byte', 'transfer', 'hash', 'extract')
+
+
+class FileMetrics(object):
+    """Timings and transfer statistics of one file in a fetch() call.
+
+    Arguments:
+        file (str): name of the file in the repository
+
+    Attributes:
+        phases (dict): seconds spent per phase
+        bytes (int): number of bytes received
+        mirror (str): base URL of the mirror which provided the file
+        source (str): 'network', 'cache', 'local' (valid file present),
+            or 'duplicate' (linked to a file with identical content)
+        cache (str): 'hit' or 'miss' if a cache was used
+        error (str): description of the error if the file failed
+    """
+    def __init__(self, file):
+        self.file = file
+        self.phases = dict()
+        self.bytes = 0
+        self.mirror = None
+        self.source = 'local'
+        self.cache = None
+        self.error = None
+        self._lock = Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def received(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    @contextmanager
+    def phase(self, name):
+        """Add the duration of a with block to a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def stream(self, chunks):
+        """Pass the chunks of a response on while timing the first byte
+        and the transfer and counting the received bytes."""
+        start = first = time.perf_counter()
+        received = 0
+        try:
+            for data in chunks:
+                if received == 0:
+                    first = time.perf_counter()
+                received += len(data)
+                yield data
+        finally:
+            stop = time.perf_counter()
+            if received == 0:
+                first = stop
+            self.add('first_byte', first - start)
+            self.add('transfer', stop - first)
+            self.received(received)
+
+    @property
+    def ttfb(self):
+        """Seconds from the request to the first byte of data"""
+        return self.phases.get('connect', 0.0) + self.phases.get(
+            'first_byte', 0.0)
+
+    @property
+    def throughput(self):
+        """Bytes per second during the transfer, None without transfer"""
+        seconds = self.phases.get('transfer', 0.0)
+        if self.bytes == 0 or seconds <= 0:
+            return None
+        return self.bytes / seconds
+
+    def as_dict(self):
+        return dict(
+            file=self.file, source=self.source, cache=self.cache,
+            mirror=self.mirror, bytes=self.bytes,
+            throughput=self.throughput, ttfb=self.ttfb,
+            phases=dict(self.phases), error=self.error)
+
+
+def measure(chunks, metrics):
+    """Time a stream of chunks if metrics (FileMetrics) are given."""
+    if metrics is None:
+        return chunks
+    return metrics.stream(chunks)
+
+
+@contextmanager
+def phase(metrics, name):
+    """Time a with block if metrics (FileMetrics) are given."""
+    if metrics is None:
+        yield
+    else:
+        with metrics.phase(name):
+            yield
+
+
+class FetchSummary(object):
+    """Metrics of one fetch() call.
+
+    Pass an instance to fetch(..., summary=...) to inspect a call, or
+    register an observer with Repository.add_observer() to receive the
+    summaries of all calls.
+
+    Arguments:
+        pattern (str): file name or pattern passed to fetch()
+
+    Attributes:
+        files (list of FileMetrics): metrics per file
+        phases (dict): seconds spent per phase outside of files (lookup)
+        started (float): UNIX time of the start of the call
+        seconds (float): duration of the call
+        error (str): description of the error if the call failed
+    """
+    def __init__(self, pattern=None):
+        self.pattern = pattern
+        self.files = []
+        self.phases = dict()
+        self.started = time.time()
+        self.seconds = None
+        self.error = None
+        self._start = time.perf_counter()
+        self._lock = Lock()
+
+    def file(self, file):
+        """Return new metrics for a file of this call."""
+        metrics = FileMetrics(file)
+        with self._lock:
+            self.files.append(metrics)
+        return metrics
+
+    @contextmanager
+    def phase(self, name):
+        """Add the duration of a with block to a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start)
+
+    def finish(self, error=None):
+        self.seconds = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+
+    @property
+    def bytes(self):
+        """Number of bytes received for all files"""
+        return sum(metrics.bytes for metrics in self.files)
+
+    @property
+    def throughput(self):
+        """Bytes per second over the whole call"""
+        if not self.seconds:
+            return None
+        return self.bytes / self.seconds
+
+    @property
+    def cache_hits(self):
+        return sum(metrics.cache == 'hit' for metrics in self.files)
+
+    @property
+    def cache_misses(self):
+        return sum(metrics.cache == 'miss' for metrics in self.files)
+
+    def as_dict(self):
+        return dict(
+            pattern=self.pattern, started=self.started, seconds=self.seconds,
+            bytes=self.bytes, throughput=self.throughput,
+            cache_hits=self.cache_hits, cache_misses=self.cache_misses,
+            phases=dict(self.phases), error=self.error,
+            files=[metrics.as_dict() for metrics in self.files])
+
+    def __str__(self):
+        from humanfriendly import format_size, format_timespan
+        string = f'Fetch: {self.pattern}\n'
+        if self.seconds is not None:
+            string += f'Time:  {format_timespan(self.seconds)}\n'
+        string += f'Size:  {format_size(self.bytes)}\n'
+        if self.error is not None:
+            string += f'Error: {self.error}\n'
+        for metrics in self.files:
+            string += f'{metrics.file} ({metrics.source}'
+            if metrics.cache is not None:
+                string += f', cache {metrics.cache}'
+            if metrics.bytes:
+                string += f', {format_size(metrics.bytes)}'
+            if metrics.throughput is not None:
+                string += f', {format_size(metrics.throughput)}/s'
+            string += ')'
+            for name in PHASES:
+                if name in metrics.phases:
+                    string += f' {name}={metrics.phases[name]:.3f}s'
+            string += '\n'
+        return string.rstrip('\n')
+
+
+class JsonLinesExporter(object):
+    """Observer which appends one JSON object per file to a file.
+
+    Each line holds the file's metrics along with the pattern, host, and
+    process of the call; lines are appended with a single write so that
+    many jobs can share one file.
+
+    Arguments:
+        path (str): path of the JSON-lines file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    def __call__(self, summary):
+        context = dict(
+            pattern=summary.pattern, started=summary.started,
+            host=socket.gethostname(), pid=os.getpid())
+        files = summary.files or [FileMetrics(None)]
+        lines = ''
+        for metrics in files:
+            record = dict(context, **metrics.as_dict())
+            if summary.error is not None and record['error'] is None:
+                record['error'] = summary.error
+            lines += json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            fd = os.open(
+                self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, lines.encode())
+            finally:
+                os.close(fd)
+
+
+class PrometheusExporter(object):
+    """Observer which keeps counters over all fetch() calls of this
+    process and writes them in the Prometheus text format.
+
+    The file is replaced atomically after each call, which suits the
+    textfile collector of the node exporter; use one file per process.
+
+    Arguments:
+        path (str): path of the .prom file
+        labels (dict): labels added to all samples, e.g., a job name
+    """
+    def __init__(self, path, labels=None):
+        self.path = path
+        self.labels = dict(labels or dict())
+        self.files = dict()
+        self.errors = 0
+        self.phase_seconds = dict()
+        self.mirror_bytes = dict()
+        self.mirror_seconds = dict()
+        self.last_success = None
+        self._lock = Lock()
+
+    def _labels(self, **labels):
+        labels = dict(self.labels, **labels)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n'))
+            for key, value in sorted(labels.items())) + '}'
+
+    def __call__(self, summary):
+        with self._lock:
+            if summary.error is None:
+                self.last_success = summary.started + (summary.seconds or 0)
+            else:
+                self.errors += 1
+            for name, seconds in summary.phases.items():
+                self.phase_seconds[name] = self.phase_seconds.get(
+                    name, 0.0) + seconds
+            for metrics in summary.files:
+                self.files[metrics.source] = self.files.get(
+                    metrics.source, 0) + 1
+                for name, seconds in metrics.phases.items():
+                    self.phase_seconds[name] = self.phase_seconds.get(
+                        name, 0.0) + seconds
+                if metrics.mirror is not None:
+                    self.mirror_bytes[metrics.mirror] = self.mirror_bytes.get(
+                        metrics.mirror, 0) + metrics.bytes
+                    self.mirror_seconds[metrics.mirror] = (
+                        self.mirror_seconds.get(metrics.mirror, 0.0)
+                        + metrics.phases.get('transfer', 0.0))
+            self.write()
+
+    def samples(self):
+        """Return the exposition text of all counters."""
+        lines = []
+
+        def metric(name, kind, text, values):
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in values:
+                lines.append(f'{name}{self._labels(**labels)} {value}')
+
+        metric(
+            'mdshare_fetch_files_total', 'counter',
+            'Files handled by fetch() by source.',
+            [(dict(source=source), count)
+             for source, count in sorted(self.files.items())])
+        metric(
+            'mdshare_fetch_errors_total', 'counter',
+            'Failed fetch() calls.', [(dict(), self.errors)])
+        metric(
+            'mdshare_fetch_phase_seconds_total', 'counter',
+            'Seconds spent per phase of fetch().',
+            [(dict(phase=name), seconds)
+             for name, seconds in sorted(self.phase_seconds.items())])
+        metric(
+            'mdshare_mirror_received_bytes_total', 'counter',
+            'Bytes received per mirror.',
+            [(dict(mirror=mirror), nbytes)
+             for mirror, nbytes in sorted(self.mirror_bytes.items())])
+        metric(
+            'mdshare_mirror_transfer_seconds_total', 'counter',
+            'Seconds spent transferring data per mirror.',
+            [(dict(mirror=mirror), seconds)
+             for mirror, seconds in sorted(self.mirror_seconds.items())])
+        if self.last_success is not None:
+            metric(
+                'mdshare_fetch_last_success_timestamp_seconds', 'gauge',
+                'UNIX time of the last successful fetch().',
+                [(dict(), self.last_success)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(self.samples())
+        os.replace(tmp, self.path)
+
+
+def notify(observers, summary):
+    """Pass a summary on to observers; failing observers are logged."""
+    for observer in list(observers):
+        try:
+            observer(summary)
+        except Exception as e:
+            logging.warning(f'metrics observer {observer} failed: {e}')
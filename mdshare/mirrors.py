@@ -0,0 +1,128 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+
+class Mirrors(object):
+    """Base URLs of a repository ranked by their observed performance.
+
+    Mirrors are probed for latency on first use and ranked by an
+    exponentially weighted moving average (EWMA) of their throughput;
+    mirrors without throughput samples follow in order of latency.
+    Mirrors which failed recently are tried last.
+
+    Arguments:
+        urls (list of str): base URLs, the first one is the primary
+        alpha (float): weight of the newest throughput sample
+        penalty (float): seconds a failed mirror stays demoted
+    """
+    def __init__(self, urls, alpha=0.3, penalty=60.0):
+        self.urls = list(dict.fromkeys(urls))
+        if len(self.urls) == 0:
+            raise ValueError('Cannot build mirrors without URLs')
+        self.alpha = alpha
+        self.penalty = penalty
+        self.latency = dict()
+        self.throughput = dict()
+        self.failures = dict()
+        self._probed = len(self.urls) == 1
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def probe(self, connection, timeout=2.0):
+        """Measure the latency of all mirrors with concurrent HEAD requests.
+
+        Arguments:
+            connection (Transport): transport used for the requests
+            timeout (float): seconds after which a mirror counts as down
+        """
+        from requests import RequestException
+
+        def head(url):
+            start = time.monotonic()
+            try:
+                connection.head(url, timeout=timeout)
+            except RequestException as e:
+                logging.debug(f'probing <{url}> failed: {e}')
+                return float('inf')
+            return time.monotonic() - start
+
+        with ThreadPoolExecutor(max_workers=len(self.urls)) as executor:
+            latencies = list(executor.map(head, self.urls))
+        with self._lock:
+            self.latency.update(zip(self.urls, latencies))
+            self._probed = True
+        for url, latency in zip(self.urls, latencies):
+            logging.debug(f'<{url}> has latency {latency:.3f}s')
+
+    def record(self, url, nbytes, seconds):
+        """Update the throughput estimate of a mirror.
+
+        Arguments:
+            url (str): base URL of the mirror
+            nbytes (int): number of bytes received
+            seconds (float): duration of the transfer
+        """
+        if nbytes <= 0 or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        with self._lock:
+            if url in self.throughput:
+                sample = self.alpha * sample + (
+                    1 - self.alpha) * self.throughput[url]
+            self.throughput[url] = sample
+
+    def failed(self, url):
+        """Demote a mirror after an error."""
+        logging.debug(f'<{url}> failed ... demoting mirror')
+        with self._lock:
+            self.failures[url] = time.monotonic()
+
+    def ranked(self, connection=None):
+        """Return the base URLs, most promising first.
+
+        Arguments:
+            connection (Transport): transport used to probe the
+                mirrors if they have not been probed yet
+        """
+        if not self._probed and connection is not None:
+            self.probe(connection)
+        now = time.monotonic()
+        with self._lock:
+            def key(url):
+                failed = now - self.failures.get(url, -self.penalty)
+                return (
+                    failed < self.penalty,
+                    -self.throughput.get(url, 0.0),
+                    self.latency.get(url, 0.0))
+            return sorted(self.urls, key=key)
+
+    def __str__(self):
+        from humanfriendly import format_size
+        string = ''
+        for url in self.ranked():
+            string += url
+            if url in self.throughput:
+                string += f' ({format_size(self.throughput[url])}/s)'
+            string += '\n'
+        return string.rstrip('\n')
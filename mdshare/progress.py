@@ -0,0 +1,118 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+from collections import namedtuple
+from threading import Lock
+
+
+class ProgressEvent(namedtuple(
+        'ProgressEvent', ('file', 'downloaded', 'total', 'done'))):
+    """Progress of a single download.
+
+    Arguments:
+        file (str): name of the file in the repository
+        downloaded (int): number of bytes received so far
+        total (int): size of the file in bytes
+        done (bool): whether all bytes have been received
+    """
+    __slots__ = ()
+
+
+class Progress(object):
+    """Download callback which passes coalesced ProgressEvents on to
+    listeners.
+
+    The downloads call it for every chunk, so the common case is two
+    comparisons: the clock is only read after step bytes, and listeners
+    are called at most every interval seconds (and for the last chunk).
+
+    Arguments:
+        file (str): name of the file in the repository
+        total (int): size of the file in bytes
+        listeners (list of callable): functions receiving ProgressEvents
+        interval (float): minimum seconds between two events
+        step (int): minimum bytes between two clock readings
+    """
+    def __init__(self, file, total, listeners, interval=0.1, step=2**18):
+        self.file = file
+        self.total = total
+        self.listeners = list(listeners)
+        self.interval = interval
+        self.step = step
+        self._next = 0
+        self._time = None
+
+    def __call__(self, n, blocksize=1):
+        downloaded = n * blocksize
+        if downloaded < self._next and downloaded < self.total:
+            return
+        self._next = downloaded + self.step
+        now = time.monotonic()
+        if downloaded < self.total and self._time is not None and (
+                now - self._time < self.interval):
+            return
+        self._time = now
+        event = ProgressEvent(
+            self.file, downloaded, self.total, downloaded >= self.total)
+        for listener in self.listeners:
+            listener(event)
+
+
+class ProgressBars(object):
+    """ProgressEvent listener which shows progress_reporter bars for each
+    registered file and, for several files, their total."""
+    tqdm_args = dict(unit='B', file=sys.stdout, unit_scale=True)
+
+    def __init__(self):
+        import progress_reporter
+        self._reporter = progress_reporter.ProgressReporter_()
+        self._stages = dict()
+        self._reported = dict()
+        self._total = 0
+        self._show_total = False
+        self._lock = Lock()
+
+    def register(self, file, size):
+        stage = len(self._stages)
+        self._stages[file] = stage
+        self._reported[file] = 0
+        self._total += size
+        self._reporter.register(
+            size, description=f'downloading {file}',
+            tqdm_args=self.tqdm_args, stage=stage)
+
+    def register_total(self):
+        if len(self._stages) > 1:
+            self._reporter.register(
+                self._total, description='total',
+                tqdm_args=self.tqdm_args, stage=-1)
+            self._show_total = True
+
+    def __call__(self, event):
+        with self._lock:
+            increment = event.downloaded - self._reported[event.file]
+            if increment <= 0:
+                return
+            self._reported[event.file] = event.downloaded
+            self._reporter.update(increment, stage=self._stages[event.file])
+            if self._show_total:
+                self._reporter.update(increment, stage=-1)
+
+    def context(self):
+        return self._reporter.context()
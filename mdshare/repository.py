@@ -15,21 +15,140 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from humanfriendly import format_size
-from yaml import safe_load
-import requests
+import os
+import re
+import json
+import bisect
 import fnmatch
-from .utils import LoadError, file_hash
+from functools import lru_cache
+from .utils import LoadError, file_hash, select_digest, url_join
+from .mirrors import Mirrors
+from .transports import get_transport
+from .metrics import notify
+
+
+def catalogue_cache_path():
+    """Return the directory of compiled (JSON) catalogues."""
+    from .cache import default_cache_path
+    return os.path.join(default_cache_path(), 'catalogues')
+
+
+def load_catalogue(catalogue_file, checksum, use_cache=True):
+    """Load a catalogue, preferring a compiled copy keyed by its checksum.
+
+    Arguments:
+        catalogue_file (str): filename of the YAML catalogue
+        checksum (str): MD5 checksum of the catalogue file
+        use_cache (boolean): read/write the compiled catalogue cache
+    """
+    compiled = os.path.join(catalogue_cache_path(), f'{checksum}.json')
+    if use_cache:
+        try:
+            with open(compiled, 'r') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            pass
+    from yaml import safe_load
+    with open(catalogue_file, 'r') as fh:
+        data = safe_load(fh)
+    if use_cache and isinstance(data, dict):
+        try:
+            os.makedirs(os.path.dirname(compiled), exist_ok=True)
+            tmp = f'{compiled}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as fh:
+                json.dump(data, fh)
+            os.replace(tmp, compiled)
+        except OSError:
+            pass
+    return data
+
+
+@lru_cache(maxsize=1024)
+def compile_pattern(pattern, regex=False):
+    """Compile a Unix shell-style (or regular expression) pattern"""
+    return re.compile(pattern if regex else fnmatch.translate(pattern))
+
+
+def literal_prefix(pattern):
+    """Return the part of a shell-style pattern before its first wildcard"""
+    match = re.search(r'[*?[]', pattern)
+    return pattern if match is None else pattern[:match.start()]
 
 
 class Category(dict):
+    """Catalogue section with a sorted key index for fast searches"""
     def __init__(self, data):
         super(Category, self).__init__(data)
+        self._keys = None
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._keys = None
+        super(Category, self).__setitem__(key, value)
 
-    def search(self, pattern):
-        return fnmatch.filter(self.keys(), pattern)
+    def __delitem__(self, key):
+        super(Category, self).__delitem__(key)
+        self._keys = None
+
+    def update(self, *args, **kwargs):
+        super(Category, self).update(*args, **kwargs)
+        self._keys = None
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._keys = None
+        return super(Category, self).setdefault(key, default)
+
+    def pop(self, *args):
+        self._keys = None
+        return super(Category, self).pop(*args)
+
+    def popitem(self):
+        self._keys = None
+        return super(Category, self).popitem()
+
+    def clear(self):
+        super(Category, self).clear()
+        self._keys = None
+
+    def _sorted_keys(self):
+        if self._keys is None:
+            self._keys = sorted(self.keys())
+        return self._keys
+
+    def _search(self, pattern, regex):
+        if regex:
+            match = compile_pattern(pattern, regex=True).fullmatch
+            return [key for key in self._sorted_keys() if match(key)]
+        prefix = literal_prefix(pattern)
+        if prefix == pattern:
+            return [pattern] if pattern in self else []
+        # only the keys starting with the literal prefix can match
+        keys = self._sorted_keys()
+        if prefix:
+            keys = keys[
+                bisect.bisect_left(keys, prefix):
+                bisect.bisect_right(keys, prefix + chr(0x10ffff))]
+        match = compile_pattern(pattern).match
+        return [key for key in keys if match(key)]
+
+    def search(self, pattern, regex=False):
+        """Return the sorted keys matching one or several patterns.
+
+        Arguments:
+            pattern (str or list of str): Unix shell-style pattern(s)
+            regex (boolean): interpret the pattern(s) as regular
+                expressions which must match the whole key
+        """
+        if isinstance(pattern, str):
+            return self._search(pattern, regex)
+        keys = set()
+        for p in pattern:
+            keys.update(self._search(p, regex))
+        return sorted(keys)
 
     def __str__(self):
+        from humanfriendly import format_size
         string = ''
         for key in sorted(self.keys()):
             size, unit = format_size(self[key]['size']).split(' ')
@@ -38,23 +157,27 @@ class Category(dict):
 
 
 class Repository(object):
-    def __init__(self, catalogue_file, checksum_file=None):
+    def __init__(
+            self, catalogue_file, checksum_file=None, use_cache=True,
+            transport=None):
+        checksum = file_hash(catalogue_file)
         if checksum_file is not None:
             with open(checksum_file, 'r') as fh:
-                if file_hash(catalogue_file) != fh.read():
+                if checksum != fh.read():
                     raise RuntimeError(
                         'Checksums do not match, check your catalogue files!')
         self.catalogue_file = catalogue_file
-        with open(self.catalogue_file, 'r') as fh:
-            data = safe_load(fh)
+        data = load_catalogue(catalogue_file, checksum, use_cache=use_cache)
         for key in ('url', 'index', 'containers'):
             if key not in data:
                 raise RuntimeError(
                     f'Cannot build repository catalogue without the {key} key')
         self.url = data['url']
+        self.mirrors = Mirrors([self.url] + list(data.get('mirrors', [])))
         self.index = Category(data['index'])
         self.containers = Category(data['containers'])
-        self._connection = None
+        self.transport = get_transport(transport)
+        self.observers = []
 
     def lookup(self, key):
         if key in self.index:
@@ -67,31 +190,130 @@ class Repository(object):
         _, data = self.lookup(key)
         return data['size']
 
-    def hash(self, key):
+    def hash(self, key, algorithm='md5'):
         _, data = self.lookup(key)
-        return data['hash']
+        field = 'hash' if algorithm == 'md5' else algorithm
+        if field not in data:
+            raise LoadError(key, f'no {algorithm} digest in catalogue')
+        return data[field]
 
-    def search(self, pattern):
-        index = set(self.index.search(pattern))
-        containers = set(self.containers.search(pattern))
+    def digest(self, key):
+        """Return the cheapest available (algorithm, hexdigest) pair"""
+        _, data = self.lookup(key)
+        digest = select_digest(data)
+        if digest is None:
+            raise LoadError(key, 'no known digest in catalogue')
+        return digest
+
+    def members(self, key):
+        """Return the catalogue entries of a container's members"""
+        location, data = self.lookup(key)
+        if location != 'containers':
+            raise LoadError(key, 'file is not a container')
+        return data.get('members', dict())
+
+    def search(self, pattern, regex=False):
+        index = set(self.index.search(pattern, regex=regex))
+        containers = set(self.containers.search(pattern, regex=regex))
         return list(sorted(index | containers))
 
-    def stack(self, pattern):
+    def stack(self, pattern, regex=False):
         stack = []
-        for file in self.search(pattern):
+        for file in self.search(pattern, regex=regex):
             location, data = self.lookup(file)
             unpack = location == 'containers'
             stack.append(
                 dict(file=file, size=data['size'], unpack=unpack))
         return stack
 
-    def _get_connection(self):
-        if self._connection is None:
-            self._connection = requests.session()
-        return self._connection
+    def mirrors_for(self, key):
+        """Return the mirrors which provide a file"""
+        return self.mirrors
+
+    def url_for(self, key, mirror=None):
+        return url_join(self.url if mirror is None else mirror, key)
+
+    def add_observer(self, observer):
+        """Register a callable which receives the FetchSummary of every
+        fetch() from this repository, e.g., a metrics exporter"""
+        if observer not in self.observers:
+            self.observers.append(observer)
+        return observer
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, summary):
+        """Pass the FetchSummary of a fetch() on to all observers"""
+        notify(self.observers, summary)
+
+    def _get_connection(self, pool_maxsize=None):
+        if pool_maxsize is not None:
+            self.transport.set_pool_maxsize(pool_maxsize)
+        return self.transport
 
     def __str__(self):
         string = f'Repository: {self.url}\n'
+        if len(self.mirrors) > 1:
+            string += f'Mirrors:\n{self.mirrors}\n'
+        string += f'Files:\n{self.index}\n'
+        string += f'Containers:\n{self.containers}'
+        return string
+
+
+class RepositoryGroup(Repository):
+    """Several repositories behind a single, merged catalogue.
+
+    Files are looked up in a precomputed index; if a file is listed in
+    more than one repository, the first repository takes precedence.
+
+    Arguments:
+        repositories (list of Repository): repositories in order of
+            precedence
+        transport (str or Transport): transport shared by all
+            repositories, see transports.get_transport()
+    """
+    def __init__(self, repositories, transport=None):
+        repositories = list(repositories)
+        if len(repositories) == 0:
+            raise ValueError('Cannot build an empty repository group')
+        for repository in repositories:
+            if not isinstance(repository, Repository):
+                raise TypeError(
+                    f'received {type(repository)} instead of Repository')
+        self.repositories = repositories
+        self.catalogue_file = None
+        self.url = ', '.join(repository.url for repository in repositories)
+        self._owners = dict()
+        index, containers = dict(), dict()
+        for repository in repositories:
+            for merged, category in (
+                    (index, repository.index),
+                    (containers, repository.containers)):
+                for key, data in category.items():
+                    if key in self._owners:
+                        continue
+                    merged[key] = data
+                    self._owners[key] = repository
+        self.index = Category(index)
+        self.containers = Category(containers)
+        self.transport = get_transport(transport)
+        self.observers = []
+
+    def owner(self, key):
+        """Return the repository which provides a file"""
+        self.lookup(key)
+        return self._owners[key]
+
+    def mirrors_for(self, key):
+        return self.owner(key).mirrors
+
+    def url_for(self, key, mirror=None):
+        return self.owner(key).url_for(key, mirror=mirror)
+
+    def __str__(self):
+        string = 'Repositories:\n' + '\n'.join(
+            repository.url for repository in self.repositories) + '\n'
         string += f'Files:\n{self.index}\n'
         string += f'Containers:\n{self.containers}'
         return string
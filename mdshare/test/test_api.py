@@ -16,13 +16,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import pytest
+import hashlib
+import asyncio
 import os
+from concurrent.futures import CancelledError
+from threading import Event, Thread
 from ..utils import LoadError
 from ..utils import file_hash
+from ..manifest import Manifest
+from ..api import get_default_repository
 from ..api import load_repository
 from ..api import search
 from ..api import catalogue
 from ..api import fetch
+from ..api import afetch
+from ..api import fetch_stream
+from ..api import fetch_bytes
+from ..api import afetch_many
+from ..cache import Cache
+from ..metrics import FetchSummary
+from ..mirrors import Mirrors
+from ..repository import RepositoryGroup
 from .. import default_repository
 
 FILE = 'mdshare-test-00.txt'
@@ -35,6 +49,17 @@ def file_check(file):
     os.remove(file)
 
 
+def teardown_module():
+    manifest = Manifest('.')
+    if os.path.exists(manifest.path):
+        os.remove(manifest.path)
+
+
+def test_get_default_repository():
+    if get_default_repository() is not default_repository:
+        raise AssertionError()
+
+
 def test_load_repository_break():
     with pytest.raises(TypeError):
         load_repository(None)
@@ -49,6 +74,10 @@ def test_search():
         raise AssertionError()
     if len(search(FILE[1:-1])) != 0:
         raise AssertionError()
+    if search([FILE, 'mdshare-test.tar.gz']) != [FILE, 'mdshare-test.tar.gz']:
+        raise AssertionError()
+    if search(r'mdshare-test-\d+\.txt', regex=True) != [FILE]:
+        raise AssertionError()
 
 
 def test_search_break():
@@ -76,6 +105,209 @@ def test_fetch():
     file_check(fetch(FILE, repository=default_repository))
 
 
+def test_fetch_container():
+    for stream_containers in (True, False):
+        file_check(fetch(
+            'mdshare-test.tar.gz', stream_containers=stream_containers))
+        if os.path.exists('mdshare-test.tar.gz'):
+            raise AssertionError()
+
+
+def test_fetch_container_members():
+    file = fetch('mdshare-test.tar.gz')
+    url, mirrors = default_repository.url, default_repository.mirrors
+    default_repository.url = 'http://localhost:0/not-a-repository'
+    default_repository.mirrors = Mirrors([default_repository.url])
+    try:
+        # all members are present, so no download is attempted
+        if fetch('mdshare-test.tar.gz') != file:
+            raise AssertionError()
+    finally:
+        default_repository.url, default_repository.mirrors = url, mirrors
+    file_check(file)
+
+
+def test_fetch_parallel():
+    file_check(fetch(FILE, max_workers=4))
+    files = fetch('mdshare-test*', max_workers=2)
+    if [os.path.basename(file) for file in files] != [FILE, FILE]:
+        raise AssertionError()
+    file_check(files[0])
+
+
+def test_fetch_progress(tmpdir):
+    events = []
+    file = fetch(
+        FILE, working_directory=tmpdir, show_progress=False,
+        on_progress=events.append)
+    if len(events) == 0 or not events[-1].done:
+        raise AssertionError()
+    if events[-1].downloaded != default_repository.size(FILE):
+        raise AssertionError()
+    events = []
+    fetch(FILE, working_directory=tmpdir, on_progress=events.append)
+    if events:
+        raise AssertionError()
+    file_check(file)
+
+
+def test_fetch_summary(tmpdir):
+    summaries = []
+    observer = default_repository.add_observer(summaries.append)
+    try:
+        summary = FetchSummary()
+        fetch(FILE, working_directory=tmpdir, summary=summary)
+        metrics = summary.files[0]
+        if metrics.file != FILE or metrics.source != 'network':
+            raise AssertionError()
+        if metrics.bytes != default_repository.size(FILE):
+            raise AssertionError()
+        for name in ('connect', 'transfer'):
+            if name not in metrics.phases:
+                raise AssertionError()
+        file_check(fetch(FILE, working_directory=tmpdir))
+        with pytest.raises(LoadError):
+            fetch('not-a-file', working_directory=tmpdir)
+    finally:
+        default_repository.remove_observer(observer)
+    if summaries[0] is not summary:
+        raise AssertionError()
+    if [s.files[0].source for s in summaries[:2]] != ['network', 'local']:
+        raise AssertionError()
+    if summaries[2].error is None:
+        raise AssertionError()
+
+
+def test_fetch_single_flight(tmpdir):
+    summaries = [FetchSummary() for _ in range(4)]
+    threads = [
+        Thread(target=fetch, args=(FILE,), kwargs=dict(
+            working_directory=tmpdir, show_progress=False, summary=summary))
+        for summary in summaries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sources = sorted(summary.files[0].source for summary in summaries)
+    if sources != ['local', 'local', 'local', 'network']:
+        raise AssertionError()
+    file_check(os.path.join(tmpdir, FILE))
+
+
+def test_fetch_cache(tmpdir):
+    cache = Cache(os.path.join(tmpdir, 'cache'))
+    file_check(fetch(FILE, cache=cache))
+    summary = FetchSummary()
+    file_check(fetch(
+        FILE, working_directory=None, cache=cache, summary=summary))
+    if cache.size() != default_repository.size(FILE):
+        raise AssertionError()
+    if summary.cache_hits != 1 or summary.files[0].source != 'cache':
+        raise AssertionError()
+
+
+def test_fetch_group_dedupe(tmpdir):
+    group = RepositoryGroup([default_repository])
+    # the alias does not exist remotely, so it must be linked, not fetched
+    group.index['mdshare-test-alias.txt'] = dict(default_repository.index[FILE])
+    group._owners['mdshare-test-alias.txt'] = default_repository
+    files = fetch('mdshare-test-*.txt', working_directory=tmpdir,
+                  repository=group, show_progress=False)
+    if sorted(os.path.basename(file) for file in files) != [
+            'mdshare-test-00.txt', 'mdshare-test-alias.txt']:
+        raise AssertionError()
+    for file in files:
+        file_check(file)
+
+
+def test_fetch_stream():
+    with fetch_stream(FILE) as stream:
+        data = b''.join(stream)
+        if not stream.verified:
+            raise AssertionError()
+    buffer = fetch_bytes(FILE)
+    if buffer.getvalue() != data:
+        raise AssertionError()
+    if hashlib.md5(buffer.getbuffer()).hexdigest() != HASH:
+        raise AssertionError()
+    if os.path.exists(FILE):
+        raise AssertionError()
+
+
+def test_fetch_stream_break():
+    with pytest.raises(LoadError):
+        fetch_stream('not-a-file')
+    with pytest.raises(TypeError):
+        fetch_bytes(FILE, repository='not-a-repository')
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_afetch():
+    file_check(run(afetch(FILE)))
+    files = run(afetch_many([FILE, f'*{FILE[1:-1]}*', FILE]))
+    if len(set(files)) != 1:
+        raise AssertionError()
+    file_check(files[0])
+
+
+def test_afetch_break():
+    with pytest.raises(ValueError):
+        run(afetch_many([FILE], max_concurrency=0))
+    with pytest.raises(TypeError):
+        run(afetch_many([FILE], repository='not-a-repository'))
+    with pytest.raises(LoadError):
+        run(afetch_many([FILE, 'not-an-existing-file-or-pattern']))
+
+
+def test_fetch_stop(tmpdir):
+    stop = Event()
+    stop.set()
+    with pytest.raises(CancelledError):
+        fetch(
+            FILE, working_directory=tmpdir, show_progress=False, stop=stop)
+    if os.path.exists(os.path.join(tmpdir, FILE)):
+        raise AssertionError()
+    stop.clear()
+    file_check(fetch(
+        FILE, working_directory=tmpdir, show_progress=False, stop=stop))
+
+
+def test_afetch_cancel(tmpdir):
+    stop, started, release = Event(), Event(), Event()
+
+    def on_progress(event):
+        started.set()
+        release.wait(5)
+
+    async def cancel():
+        task = asyncio.ensure_future(afetch_many(
+            [FILE], working_directory=tmpdir, show_progress=False,
+            on_progress=on_progress, stop=stop))
+        # a failing download never reports progress
+        while not started.is_set() and not task.done():
+            await asyncio.sleep(0.01)
+        if task.done():
+            task.result()
+            raise AssertionError()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    try:
+        run(cancel())
+    finally:
+        release.set()
+    # the running download was told to stop
+    if not stop.is_set():
+        raise AssertionError()
+
+
 def test_fetch_break():
     file = fetch(FILE)
     with pytest.raises(FileExistsError):
@@ -87,3 +319,9 @@ def test_fetch_break():
         fetch('not-an-existing-file-or-pattern')
     with pytest.raises(TypeError):
         fetch(FILE, repository='not-a-repository')
+    with pytest.raises(ValueError):
+        fetch(FILE, max_workers=0)
+    with pytest.raises(TypeError):
+        fetch(FILE, cache='not-a-cache')
+    with pytest.raises(ValueError):
+        fetch(FILE, verify='partial')
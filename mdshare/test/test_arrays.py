@@ -0,0 +1,195 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import pytest
+from yaml import dump
+from ..api import load
+from ..api import open_npz
+from ..arrays import UNPACKED_DIRECTORY
+from ..arrays import map_npy
+from ..arrays import map_npz
+from ..mirrors import Mirrors
+from ..repository import Repository
+from ..transports import FileTransport
+from ..utils import LoadError
+from ..utils import file_hash
+
+np = pytest.importorskip('numpy')
+
+ARRAYS = dict(
+    c=np.arange(1000, dtype=np.float32).reshape(500, 2),
+    f=np.asfortranarray(np.arange(12, dtype=np.int64).reshape(3, 4)),
+    s=np.array(3.5),
+    e=np.zeros((0, 3)))
+
+
+def check(arrays, mapped=('c', 'f', 's')):
+    if sorted(arrays) != sorted(ARRAYS):
+        raise AssertionError()
+    for key, array in ARRAYS.items():
+        if not np.array_equal(arrays[key], array):
+            raise AssertionError()
+        if arrays[key].dtype != array.dtype:
+            raise AssertionError()
+        if key in mapped and not isinstance(arrays[key], np.memmap):
+            raise AssertionError()
+
+
+def test_map_npy(tmpdir):
+    for key, array in ARRAYS.items():
+        path = os.path.join(tmpdir, f'{key}.npy')
+        np.save(path, array)
+        mapped = map_npy(path)
+        if not np.array_equal(mapped, array):
+            raise AssertionError()
+        if key != 'e' and not isinstance(mapped, np.memmap):
+            raise AssertionError()
+
+
+def test_map_npz(tmpdir):
+    path = os.path.join(tmpdir, 'stored.npz')
+    np.savez(path, **ARRAYS)
+    check(map_npz(path))
+    if os.path.exists(os.path.join(tmpdir, UNPACKED_DIRECTORY)):
+        raise AssertionError()
+
+
+def test_map_npz_compressed(tmpdir):
+    path = os.path.join(tmpdir, 'compressed.npz')
+    np.savez_compressed(path, **ARRAYS)
+    check(map_npz(path))
+    unpacked = os.path.join(tmpdir, UNPACKED_DIRECTORY)
+    directories = os.listdir(unpacked)
+    if len(directories) != 1:
+        raise AssertionError()
+    # members are unpacked once ...
+    check(map_npz(path))
+    if os.listdir(unpacked) != directories:
+        raise AssertionError()
+    # ... and again if the archive changes
+    np.savez_compressed(path, **ARRAYS)
+    os.utime(path, ns=(0, 0))
+    check(map_npz(path))
+    if len(os.listdir(unpacked)) != 1 or os.listdir(unpacked) == directories:
+        raise AssertionError()
+
+
+def make_local_repository(tmpdir):
+    directory = os.path.join(tmpdir, 'repository')
+    os.makedirs(directory)
+    np.savez(os.path.join(directory, 'arrays.npz'), **ARRAYS)
+    np.savez_compressed(os.path.join(directory, 'compressed.npz'), **ARRAYS)
+    np.save(os.path.join(directory, 'array.npy'), ARRAYS['c'])
+    with open(os.path.join(directory, 'notes.txt'), 'w') as fh:
+        fh.write('mdshare')
+    catalogue = os.path.join(tmpdir, 'catalogue.yaml')
+    with open(catalogue, 'w') as fh:
+        fh.write(dump(dict(
+            url=directory,
+            index={file: dict(
+                size=os.path.getsize(os.path.join(directory, file)),
+                hash=file_hash(os.path.join(directory, file)))
+                for file in os.listdir(directory)},
+            containers=dict())))
+    return Repository(catalogue, use_cache=False)
+
+
+def test_load(tmpdir):
+    repository = make_local_repository(tmpdir)
+    working_directory = os.path.join(tmpdir, 'work')
+    check(load(
+        'arrays.npz', working_directory=working_directory,
+        repository=repository, show_progress=False))
+    array, arrays = load(
+        'array*.np?', working_directory=working_directory,
+        repository=repository, show_progress=False)
+    if not isinstance(array, np.memmap):
+        raise AssertionError()
+    check(arrays)
+    with pytest.raises(LoadError):
+        load('*', working_directory=working_directory, repository=repository)
+    if os.path.exists(os.path.join(working_directory, 'notes.txt')):
+        raise AssertionError()
+
+
+def test_open_npz(tmpdir):
+    repository = make_local_repository(tmpdir)
+    cache_directory = os.path.join(tmpdir, 'cache')
+    for file in ('arrays.npz', 'compressed.npz'):
+        with open_npz(
+                file, repository=repository,
+                cache_directory=cache_directory) as npz:
+            # a single request for the central directory
+            if npz._remote.requests != 1:
+                raise AssertionError()
+            if sorted(npz) != sorted(ARRAYS) or len(npz) != len(ARRAYS):
+                raise AssertionError()
+            if npz.shapes != {
+                    key: array.shape for key, array in ARRAYS.items()}:
+                raise AssertionError()
+            if npz.dtypes['c'] != ARRAYS['c'].dtype:
+                raise AssertionError()
+            requests = npz._remote.requests
+            if not isinstance(npz['c'], np.memmap):
+                raise AssertionError()
+            if npz._remote.requests != requests + 1:
+                raise AssertionError()
+            check({key: npz[key] for key in npz}, mapped=('c', 'f', 's'))
+            requests = npz._remote.requests
+            npz['c']
+            # fetched arrays are cached
+            if npz._remote.requests != requests:
+                raise AssertionError()
+
+
+class IgnoreRangeTransport(FileTransport):
+    def get(self, url, headers=None):
+        if '/ignores-range/' in url:
+            headers = None
+        return super(IgnoreRangeTransport, self).get(url, headers=headers)
+
+
+def test_open_npz_failover(tmpdir):
+    repository = make_local_repository(tmpdir)
+    directory = repository.url
+    ignores_range = os.path.join(tmpdir, 'ignores-range')
+    shutil.copytree(directory, ignores_range)
+    repository = Repository(
+        os.path.join(tmpdir, 'catalogue.yaml'), use_cache=False,
+        transport=IgnoreRangeTransport())
+    repository.mirrors = Mirrors([ignores_range + '/', directory])
+    # make the mirror without Range support look fast
+    repository.mirrors.record(ignores_range + '/', 10**9, 1.0)
+    with open_npz(
+            'arrays.npz', repository=repository,
+            cache_directory=os.path.join(tmpdir, 'cache')) as npz:
+        check({key: npz[key] for key in npz}, mapped=('c', 'f', 's'))
+    if ignores_range + '/' not in repository.mirrors.failures:
+        raise AssertionError()
+    # without any mirror supporting Range, reading fails
+    repository.mirrors = Mirrors([ignores_range + '/'])
+    with pytest.raises(LoadError):
+        open_npz('arrays.npz', repository=repository)
+
+
+def test_open_npz_break(tmpdir):
+    repository = make_local_repository(tmpdir)
+    for file in ('array.npy', 'not-a-file.npz'):
+        with pytest.raises(LoadError):
+            open_npz(file, repository=repository)
@@ -0,0 +1,87 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from ..bandwidth import RateLimiter
+from ..bandwidth import get_bandwidth_limiter
+from ..bandwidth import set_bandwidth_limit
+from ..bandwidth import throttle
+
+RATE = 4e6
+CHUNK = 8192
+
+
+def transfer(limiters, nbytes, progress=None):
+    """Pass nbytes through the limiters in chunks, round robin."""
+    chunks = [b'x' * CHUNK] * (nbytes // CHUNK)
+    start = time.monotonic()
+    for i, chunk in enumerate(chunks):
+        limiters[i % len(limiters)].acquire(len(chunk))
+        if progress is not None:
+            progress.append(time.monotonic())
+    return time.monotonic() - start
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(RATE, burst=CHUNK)
+    elapsed = transfer([limiter], int(RATE / 5))
+    if not 0.15 < elapsed < 0.4:
+        raise AssertionError()
+
+
+def test_rate_limiter_fair():
+    limiter = RateLimiter(RATE, burst=CHUNK)
+    progress = [[] for _ in range(4)]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(
+            lambda p: transfer([limiter], int(RATE / 20), progress=p),
+            progress))
+    # all downloads proceed concurrently and finish at about the same time
+    finished = sorted(p[-1] for p in progress)
+    if finished[-1] - finished[0] > 0.05:
+        raise AssertionError()
+
+
+def test_rate_limiter_shared(tmpdir):
+    path = os.path.join(tmpdir, 'bandwidth')
+    limiters = [RateLimiter(RATE, burst=CHUNK, path=path) for _ in range(2)]
+    elapsed = transfer(limiters, int(RATE / 5))
+    if not 0.15 < elapsed < 0.4:
+        raise AssertionError()
+
+
+def test_set_bandwidth_limit(tmpdir):
+    try:
+        limiter = set_bandwidth_limit(
+            '2 MB', shared=os.path.join(tmpdir, 'bandwidth'))
+        if get_bandwidth_limiter() is not limiter or limiter.rate != 2e6:
+            raise AssertionError()
+        if list(throttle(iter([b'x']))) != [b'x']:
+            raise AssertionError()
+    finally:
+        set_bandwidth_limit(None)
+    chunks = iter([b'x'])
+    if throttle(chunks) is not chunks:
+        raise AssertionError()
+
+
+def test_rate_limiter_break():
+    with pytest.raises(ValueError):
+        RateLimiter(0)
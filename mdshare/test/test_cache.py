@@ -0,0 +1,130 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import pytest
+from .. import default_repository as REPO
+from ..cache import Cache
+from ..cache import materialize
+from ..utils import file_hash
+
+FILE = 'mdshare-test-00.txt'
+HASH = '5cbb04531c2e9fa7cc1e5d83195a2f81'
+
+
+def add_entry(cache, key, size, last_used):
+    path = cache._entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        fh.write(b'x' * size)
+    os.utime(path, (last_used, last_used))
+
+
+def test_materialize(tmpdir):
+    source = os.path.join(tmpdir, 'source')
+    with open(source, 'w') as fh:
+        fh.write('mdshare')
+    for link in ('auto', 'hardlink', 'symlink', 'copy'):
+        target = os.path.join(tmpdir, link)
+        used = materialize(source, target, link=link)
+        if link != 'auto' and used != link:
+            raise AssertionError()
+        if file_hash(target) != file_hash(source):
+            raise AssertionError()
+    if not os.path.islink(os.path.join(tmpdir, 'symlink')):
+        raise AssertionError()
+    if os.stat(os.path.join(tmpdir, 'hardlink')).st_nlink < 2:
+        raise AssertionError()
+
+
+def test_materialize_break(tmpdir):
+    with pytest.raises(ValueError):
+        materialize('LICENSE', os.path.join(tmpdir, 'x'), link='teleport')
+    with pytest.raises(FileNotFoundError):
+        materialize(
+            os.path.join(tmpdir, 'not-a-file'),
+            os.path.join(tmpdir, 'x'), link='copy')
+
+
+def test_cache(tmpdir):
+    cache = Cache(os.path.join(tmpdir, 'cache'))
+    now = time.time()
+    for i, key in enumerate(('aaaa', 'bbbb', 'cccc')):
+        add_entry(cache, key, 100, now - 100 + i)
+    if cache.size() != 300:
+        raise AssertionError()
+    if [entry['hash'] for entry in cache.entries()] != [
+            'aaaa', 'bbbb', 'cccc']:
+        raise AssertionError()
+    if 'aaaa' not in cache or 'dddd' in cache:
+        raise AssertionError()
+    if cache.get('dddd') is not None:
+        raise AssertionError()
+    # using aaaa makes bbbb the least recently used entry
+    cache.get('aaaa')
+    if cache.prune() != []:
+        raise AssertionError()
+    if cache.prune(max_size=200) != ['bbbb']:
+        raise AssertionError()
+    if cache.prune(max_size=0, keep=('aaaa',)) != ['cccc']:
+        raise AssertionError()
+    cache.clear()
+    if cache.size() != 0:
+        raise AssertionError()
+    if 'Files: 0' not in str(cache):
+        raise AssertionError()
+
+
+def test_cache_get_keeps_entry(tmpdir, monkeypatch):
+    cache = Cache(os.path.join(tmpdir, 'cache'))
+    add_entry(cache, 'aaaa', 100, 1000)
+    os.chmod(cache._entry_path('aaaa'), 0o444)
+    cache.get('aaaa')
+    # hits must not modify the (possibly hardlinked) entry itself
+    if os.stat(cache._entry_path('aaaa')).st_mtime != 1000:
+        raise AssertionError()
+    if [entry['hash'] for entry in cache.entries()] != ['aaaa']:
+        raise AssertionError()
+    if cache.entries()[0]['last_used'] <= 1000:
+        raise AssertionError()
+
+    def utime(*args, **kwargs):
+        raise PermissionError('read-only cache')
+    monkeypatch.setattr(os, 'utime', utime)
+    if cache.get('aaaa') != cache._entry_path('aaaa'):
+        raise AssertionError()
+    if cache.prune(max_size=0) != ['aaaa']:
+        raise AssertionError()
+    if os.listdir(os.path.dirname(cache._entry_path('aaaa'))):
+        raise AssertionError()
+
+
+def test_cache_break(tmpdir):
+    with pytest.raises(ValueError):
+        Cache(os.path.join(tmpdir, 'cache'), link='teleport')
+
+
+def test_cache_retrieve(tmpdir):
+    cache = Cache(os.path.join(tmpdir, 'cache'), max_size=0)
+    for i in range(2):
+        local_path = os.path.join(tmpdir, f'{FILE}.{i}')
+        cache.retrieve(REPO, FILE, local_path)
+        if file_hash(local_path) != HASH:
+            raise AssertionError()
+    if [entry['hash'] for entry in cache.entries()] != [REPO.hash(FILE)]:
+        raise AssertionError()
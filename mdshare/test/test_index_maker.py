@@ -0,0 +1,192 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from yaml import dump, safe_load
+from ..utils import file_hash
+
+SCRIPT = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'bin', 'mdshare-index-maker.py')
+# files older than the build manifest's racy window
+PAST = 10**9
+
+
+@pytest.fixture
+def index_maker(tmpdir, monkeypatch):
+    if not os.path.exists(SCRIPT):
+        pytest.skip('index-maker script not available')
+    spec = importlib.util.spec_from_file_location('index_maker', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, 'index_maker', module)
+    spec.loader.exec_module(module)
+    # workers in threads count calls regardless of the start method
+    monkeypatch.setattr(module, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.chdir(tmpdir)
+    return module
+
+
+def write(path, content, mtime=PAST):
+    with open(path, 'w') as fh:
+        fh.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+def count_hashes(index_maker, monkeypatch):
+    hashed = []
+    hash_file = index_maker.hash_file
+
+    def counting(file, digests=()):
+        hashed.append(file)
+        return hash_file(file, digests)
+    monkeypatch.setattr(index_maker, 'hash_file', counting)
+    return hashed
+
+
+def test_hash_files(index_maker, monkeypatch):
+    hashed = count_hashes(index_maker, monkeypatch)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        write(name, name)
+    files = ['a.txt', 'b.txt', 'c.txt']
+    metadata = index_maker.hash_files(files, max_workers=2)
+    if sorted(hashed) != files:
+        raise AssertionError()
+    if metadata['a.txt'] != dict(hash=file_hash('a.txt'), size=5):
+        raise AssertionError()
+    # unchanged files are taken from the build manifest
+    del hashed[:]
+    if index_maker.hash_files(files) != metadata or hashed:
+        raise AssertionError()
+    # touched files and newly requested digests are hashed again
+    os.utime('b.txt', (PAST + 1, PAST + 1))
+    if index_maker.hash_files(files) != metadata or hashed != ['b.txt']:
+        raise AssertionError()
+    del hashed[:]
+    metadata = index_maker.hash_files(files, digests=['sha256'])
+    if sorted(hashed) != files or 'sha256' not in metadata['c.txt']:
+        raise AssertionError()
+    del hashed[:]
+    index_maker.hash_files(files, digests=['sha256'])
+    if hashed:
+        raise AssertionError()
+
+
+def test_hash_files_racy(index_maker, monkeypatch):
+    hashed = count_hashes(index_maker, monkeypatch)
+    # a file modified right before hashing may change unnoticed
+    with open('a.txt', 'w') as fh:
+        fh.write('a')
+    index_maker.hash_files(['a.txt'])
+    index_maker.hash_files(['a.txt'])
+    if hashed != ['a.txt', 'a.txt']:
+        raise AssertionError()
+
+
+def build_catalogue(index_maker, capsys):
+    index_maker.build('template.yaml')
+    with open('test.yaml') as fh:
+        catalogue = safe_load(fh)
+    return catalogue, capsys.readouterr().out
+
+
+def test_build_containers(index_maker, capsys):
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        write(name, name * 1000)
+    with open('template.yaml', 'w') as fh:
+        fh.write(dump(dict(
+            name='test', url='http://localhost/',
+            include=['*.txt'],
+            containers={
+                'ab.tar.gz': ['a.txt', 'b.txt'],
+                'c.tar.gz': ['c.txt']})))
+    catalogue, out = build_catalogue(index_maker, capsys)
+    if 'building 2 of 2 containers' not in out:
+        raise AssertionError()
+    containers = catalogue['containers']
+    if sorted(containers['ab.tar.gz']['members']) != ['a.txt', 'b.txt']:
+        raise AssertionError()
+    if containers['c.tar.gz']['hash'] != file_hash('c.tar.gz'):
+        raise AssertionError()
+    # unchanged members: nothing is rebuilt
+    if 'building 0 of 2 containers' not in build_catalogue(
+            index_maker, capsys)[1]:
+        raise AssertionError()
+    # touched members and a fresh build give byte-identical containers
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        os.utime(name, (PAST + 100, PAST + 100))
+    os.remove('ab.tar.gz')
+    os.remove(index_maker.BuildManifest.filename)
+    rebuilt, out = build_catalogue(index_maker, capsys)
+    if 'building 2 of 2 containers' not in out:
+        raise AssertionError()
+    if rebuilt['containers'] != containers:
+        raise AssertionError()
+    # a changed member only rebuilds its container
+    write('c.txt', 'changed')
+    rebuilt, out = build_catalogue(index_maker, capsys)
+    if 'building 1 of 2 containers' not in out:
+        raise AssertionError()
+    if rebuilt['containers']['ab.tar.gz'] != containers['ab.tar.gz']:
+        raise AssertionError()
+    if rebuilt['containers']['c.tar.gz']['hash'] == containers[
+            'c.tar.gz']['hash']:
+        raise AssertionError()
+
+
+def test_verify(index_maker, capsys, tmpdir):
+    mirror = os.path.join(tmpdir, 'mirror')
+    os.mkdir(mirror)
+    for name in ('a.txt', 'b.txt'):
+        write(name, name * 1000)
+        write(os.path.join(mirror, name), name * 1000)
+    with open('template.yaml', 'w') as fh:
+        fh.write(dump(dict(
+            name='test', url=f'file://{tmpdir}/',
+            mirrors=[f'file://{mirror}/'],
+            include=['*.txt'], containers=dict())))
+    build_catalogue(index_maker, capsys)
+    summary = index_maker.verify('test.yaml', 'test.md5', max_workers=2)
+    if summary['checks'] != ['hash'] or summary['files'] != 2:
+        raise AssertionError()
+    if len(summary['mirrors']) != 2 or summary['failed']:
+        raise AssertionError()
+    if len(summary['records']) != 4 or summary['bytes'] != 2 * 2 * 5000:
+        raise AssertionError()
+    for key in ('file', 'mirror', 'check', 'size', 'ok', 'error', 'bytes',
+                'seconds', 'throughput'):
+        if key not in summary['records'][0]:
+            raise AssertionError()
+    # a corrupted copy fails on its mirror only
+    write(os.path.join(mirror, 'a.txt'), 'x' * 5000)
+    summary = index_maker.verify('test.yaml', 'test.md5', headers=True)
+    if summary['checks'] != ['headers', 'hash']:
+        raise AssertionError()
+    if summary['failed'] != [dict(file='a.txt', mirror=f'file://{mirror}/')]:
+        raise AssertionError()
+    # headers only catch files with the wrong size
+    summary = index_maker.verify('test.yaml', 'test.md5', headers_only=True)
+    if summary['checks'] != ['headers'] or summary['failed']:
+        raise AssertionError()
+    if summary['bytes'] != 0 or len(summary['records']) != 4:
+        raise AssertionError()
+    write('b.txt', 'b')
+    summary = index_maker.verify('test.yaml', 'test.md5', headers_only=True)
+    if summary['failed'] != [dict(file='b.txt', mirror=f'file://{tmpdir}/')]:
+        raise AssertionError()
@@ -0,0 +1,91 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import socket
+import pytest
+import subprocess
+import sys
+from threading import Thread
+from .. import locking
+from ..locking import FileLock
+
+
+@pytest.fixture(params=['flock', 'lockfile'])
+def mode(request, monkeypatch):
+    if request.param == 'lockfile':
+        monkeypatch.setattr(locking, 'fcntl', None)
+    elif locking.fcntl is None:
+        pytest.skip('no fcntl on this platform')
+    return request.param
+
+
+def test_file_lock(tmpdir, mode):
+    path = str(tmpdir.join('file'))
+    with FileLock(path) as lock:
+        if lock.waited or not os.path.exists(f'{path}.lock'):
+            raise AssertionError()
+        with pytest.raises(TimeoutError):
+            FileLock(path, timeout=0.2).acquire()
+    if os.path.exists(f'{path}.lock'):
+        raise AssertionError()
+
+
+def test_file_lock_wait(tmpdir, mode):
+    path = str(tmpdir.join('file'))
+    events = []
+
+    def hold():
+        with FileLock(path):
+            events.append('acquired')
+            time.sleep(0.3)
+            events.append('released')
+
+    thread = Thread(target=hold)
+    thread.start()
+    while not events:
+        time.sleep(0.01)
+    with FileLock(path) as lock:
+        if not lock.waited or events != ['acquired', 'released']:
+            raise AssertionError()
+    thread.join()
+
+
+def test_file_lock_stale(tmpdir, monkeypatch):
+    monkeypatch.setattr(locking, 'fcntl', None)
+    path = str(tmpdir.join('file'))
+    # a process which is gone
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    with open(f'{path}.lock', 'w') as fh:
+        fh.write(f'{socket.gethostname()} {process.pid}')
+    with FileLock(path, timeout=1):
+        pass
+    # a lock which is not refreshed anymore
+    with open(f'{path}.lock', 'w') as fh:
+        fh.write(f'elsewhere {os.getpid()}')
+    past = time.time() - 120
+    os.utime(f'{path}.lock', (past, past))
+    with FileLock(path, timeout=1, stale=60):
+        pass
+    # a live holder is respected
+    with open(f'{path}.lock', 'w') as fh:
+        fh.write(f'{socket.gethostname()} {os.getpid()}')
+    with pytest.raises(TimeoutError):
+        FileLock(path, timeout=0.2).acquire()
+    os.remove(f'{path}.lock')
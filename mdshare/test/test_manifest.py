@@ -0,0 +1,139 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+from ..manifest import Manifest
+from ..utils import file_hash
+
+
+def write(path, content):
+    with open(path, 'w') as fh:
+        fh.write(content)
+
+
+def test_manifest(tmpdir):
+    manifest = Manifest(tmpdir)
+    path = os.path.join(tmpdir, 'file')
+    write(path, 'mdshare')
+    checksum = file_hash(path)
+    for mode in ('none', 'fast', 'full'):
+        if not manifest.verify('file', 'md5', checksum, mode=mode):
+            raise AssertionError()
+    if manifest.load()['file']['hash'] != checksum:
+        raise AssertionError()
+    # a wrong size is detected without hashing
+    if manifest.verify('file', 'md5', checksum, size=1):
+        raise AssertionError()
+    # an untouched file is trusted in fast mode only
+    if not manifest.verify('file', 'md5', checksum):
+        raise AssertionError()
+    if manifest.verify('file', 'md5', 'x' * 32):
+        raise AssertionError()
+    write(path, 'MDSHARE')
+    if manifest.verify('file', 'md5', checksum):
+        raise AssertionError()
+    if not manifest.verify('file', 'md5', checksum, mode='none'):
+        raise AssertionError()
+    if manifest.verify('not-a-file', 'md5', checksum, mode='none'):
+        raise AssertionError()
+    os.remove(path)
+    write(os.path.join(tmpdir, 'other'), 'mdshare')
+    manifest.record('other', 'md5', checksum)
+    # entries of removed files are only dropped on demand
+    if sorted(manifest.load()) != ['file', 'other']:
+        raise AssertionError()
+    manifest.prune()
+    if list(manifest.load()) != ['other']:
+        raise AssertionError()
+
+
+def test_manifest_all(tmpdir):
+    manifest = Manifest(tmpdir)
+    entries = dict()
+    for name in ('a', 'b'):
+        path = os.path.join(tmpdir, name)
+        write(path, name)
+        entries[name] = dict(hash=file_hash(path), size=1)
+    if not manifest.verify_all(entries):
+        raise AssertionError()
+    manifest.record_all({
+        name: ('md5', entry['hash']) for name, entry in entries.items()})
+    if sorted(manifest.load()) != ['a', 'b']:
+        raise AssertionError()
+    entries['c'] = dict(hash=file_hash(path), size=1)
+    if manifest.verify_all(entries):
+        raise AssertionError()
+
+
+def test_manifest_batch(tmpdir, monkeypatch):
+    manifest = Manifest(tmpdir)
+    writes = []
+    update = manifest._update
+    monkeypatch.setattr(
+        manifest, '_update',
+        lambda *args, **kwargs: writes.append(args) or update(
+            *args, **kwargs))
+    checksums = dict()
+    for name in ('a', 'b', 'c'):
+        path = os.path.join(tmpdir, name)
+        write(path, name)
+        checksums[name] = file_hash(path)
+    with manifest.batch():
+        with manifest.batch():
+            manifest.record('a', 'md5', checksums['a'])
+        # hashed files are recorded as well, and pending records count
+        for name in ('b', 'c', 'a'):
+            if not manifest.verify(name, 'md5', checksums[name]):
+                raise AssertionError()
+        if os.path.exists(manifest.path):
+            raise AssertionError()
+    if len(writes) != 1 or sorted(manifest.load()) != ['a', 'b', 'c']:
+        raise AssertionError()
+    # another manifest object sees the changes, unchanged files are
+    # not parsed again
+    other = Manifest(tmpdir)
+    if other.load() != manifest.load():
+        raise AssertionError()
+    if other.load() is not other.load():
+        raise AssertionError()
+    other.record('a', 'md5', checksums['a'])
+    if len(writes) != 1 or manifest.load() != other.load():
+        raise AssertionError()
+
+
+def test_manifest_read_only(tmpdir, monkeypatch):
+    from .. import manifest as module
+
+    def read_only(path):
+        raise OSError(30, 'Read-only file system', path + '.lock')
+    monkeypatch.setattr(module, 'FileLock', read_only)
+    manifest = Manifest(tmpdir)
+    path = os.path.join(tmpdir, 'file')
+    write(path, 'mdshare')
+    # verified files are reported even if the manifest cannot be written
+    if not manifest.verify('file', 'md5', file_hash(path)):
+        raise AssertionError()
+    if manifest.load() != dict():
+        raise AssertionError()
+
+
+def test_manifest_break(tmpdir):
+    with pytest.raises(ValueError):
+        Manifest(tmpdir).verify('file', 'md5', 'x' * 32, mode='partial')
+    with pytest.raises(FileNotFoundError):
+        Manifest(tmpdir).record('not-a-file', 'md5', 'x' * 32)
@@ -0,0 +1,92 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from ..metrics import FetchSummary
+from ..metrics import JsonLinesExporter
+from ..metrics import PrometheusExporter
+from ..metrics import measure
+
+
+def make_summary():
+    summary = FetchSummary('*.txt')
+    with summary.phase('lookup'):
+        pass
+    metrics = summary.file('a.txt')
+    metrics.source, metrics.mirror = 'network', 'http://mirror/'
+    with metrics.phase('connect'):
+        pass
+    if b''.join(measure(iter([b'abc', b'defg']), metrics)) != b'abcdefg':
+        raise AssertionError()
+    summary.file('b.txt')
+    summary.finish()
+    return summary
+
+
+def test_measure():
+    chunks = iter([b'abc'])
+    if measure(chunks, None) is not chunks:
+        raise AssertionError()
+    summary = make_summary()
+    metrics = summary.files[0]
+    for name in ('connect', 'first_byte', 'transfer'):
+        if name not in metrics.phases:
+            raise AssertionError()
+    if metrics.bytes != 7 or summary.bytes != 7:
+        raise AssertionError()
+    if metrics.ttfb < metrics.phases['connect']:
+        raise AssertionError()
+    if summary.files[1].throughput is not None:
+        raise AssertionError()
+    if 'lookup' not in summary.phases or summary.seconds is None:
+        raise AssertionError()
+
+
+def test_json_lines_exporter(tmpdir):
+    path = str(tmpdir.join('metrics.jsonl'))
+    exporter = JsonLinesExporter(path)
+    exporter(make_summary())
+    failed = FetchSummary('missing')
+    failed.finish(error=KeyError('missing'))
+    exporter(failed)
+    with open(path) as fh:
+        records = [json.loads(line) for line in fh]
+    if [record['file'] for record in records] != ['a.txt', 'b.txt', None]:
+        raise AssertionError()
+    if records[0]['bytes'] != 7 or records[0]['pattern'] != '*.txt':
+        raise AssertionError()
+    if records[2]['error'] is None:
+        raise AssertionError()
+
+
+def test_prometheus_exporter(tmpdir):
+    path = str(tmpdir.join('mdshare.prom'))
+    exporter = PrometheusExporter(path, labels=dict(job='test'))
+    exporter(make_summary())
+    exporter(make_summary())
+    with open(path) as fh:
+        text = fh.read()
+    for line in (
+            'mdshare_fetch_files_total{job="test",source="network"} 2',
+            'mdshare_fetch_files_total{job="test",source="local"} 2',
+            'mdshare_fetch_errors_total{job="test"} 0',
+            'mdshare_mirror_received_bytes_total'
+            '{job="test",mirror="http://mirror/"} 14'):
+        if line not in text.splitlines():
+            raise AssertionError()
+    if 'phase="transfer"' not in text:
+        raise AssertionError()
@@ -0,0 +1,54 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+from ..mirrors import Mirrors
+
+URLS = ['http://a.example/', 'http://b.example/', 'http://c.example/']
+
+
+def test_mirrors():
+    mirrors = Mirrors(URLS + URLS[:1])
+    if len(mirrors) != 3 or mirrors.ranked() != URLS:
+        raise AssertionError()
+    mirrors.latency.update({URLS[0]: 0.3, URLS[1]: 0.2, URLS[2]: 0.1})
+    if mirrors.ranked() != URLS[::-1]:
+        raise AssertionError()
+    # measured throughput beats latency
+    mirrors.record(URLS[1], 1000, 1.0)
+    if mirrors.ranked()[0] != URLS[1]:
+        raise AssertionError()
+    mirrors.record(URLS[1], 0, 1.0)
+    if mirrors.throughput[URLS[1]] != 1000:
+        raise AssertionError()
+    mirrors.record(URLS[1], 2000, 1.0)
+    if mirrors.throughput[URLS[1]] != 1300:
+        raise AssertionError()
+    # failed mirrors are tried last
+    mirrors.failed(URLS[1])
+    if mirrors.ranked() != [URLS[2], URLS[0], URLS[1]]:
+        raise AssertionError()
+    mirrors.penalty = 0.0
+    if mirrors.ranked()[0] != URLS[1]:
+        raise AssertionError()
+    if '1.3 KB/s' not in str(mirrors):
+        raise AssertionError()
+
+
+def test_mirrors_break():
+    with pytest.raises(ValueError):
+        Mirrors([])
@@ -0,0 +1,46 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from ..progress import Progress
+
+
+def test_progress_coalesces_chunks():
+    events = []
+    progress = Progress('file', 10 * 2**20, [events.append], interval=3600)
+    for n in range(1, 1281):
+        progress(n, 8192)
+    if len(events) != 2:
+        raise AssertionError()
+    if events[0].downloaded != 8192 or events[0].done:
+        raise AssertionError()
+    if events[-1].downloaded != 10 * 2**20 or not events[-1].done:
+        raise AssertionError()
+
+
+def test_progress_step():
+    events = []
+    progress = Progress(
+        'file', 2**20, [events.append, events.append], interval=0, step=2**18)
+    for n in range(1, 129):
+        progress(n, 8192)
+    if len(events) != 2 * 5:
+        raise AssertionError()
+    if [event.downloaded for event in events[::2]] != [
+            8192, 270336, 532480, 794624, 2**20]:
+        raise AssertionError()
+    if sum(event.done for event in events) != 2:
+        raise AssertionError()
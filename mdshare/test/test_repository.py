@@ -19,11 +19,32 @@ import random
 import string
 import pytest
 import os
+import shutil
+from tempfile import mkdtemp
 from yaml import dump
 from ..utils import LoadError
 from ..utils import file_hash
 from ..repository import Category
 from ..repository import Repository
+from ..repository import RepositoryGroup
+from ..repository import catalogue_cache_path
+from ..repository import load_catalogue
+from ..repository import literal_prefix
+
+XDG_CACHE_HOME = os.environ.get('XDG_CACHE_HOME')
+
+
+def setup_module():
+    # keep compiled catalogues of random test repositories out of ~/.cache
+    os.environ['XDG_CACHE_HOME'] = mkdtemp()
+
+
+def teardown_module():
+    shutil.rmtree(os.environ['XDG_CACHE_HOME'])
+    if XDG_CACHE_HOME is None:
+        del os.environ['XDG_CACHE_HOME']
+    else:
+        os.environ['XDG_CACHE_HOME'] = XDG_CACHE_HOME
 
 
 def randomizer(length, pattern=None):
@@ -99,6 +120,47 @@ def test_category():
             raise AssertionError()
 
 
+def test_literal_prefix():
+    for pattern, prefix in (
+            ('abc', 'abc'), ('ab*c', 'ab'), ('a?c', 'a'),
+            ('[ab]c', ''), ('*', '')):
+        if literal_prefix(pattern) != prefix:
+            raise AssertionError()
+
+
+def test_category_search():
+    n, m = random.randint(2, 6), random.randint(2, 6)
+    patterns, files, data = make_random_category_dict(n, m)
+    category = Category(data)
+    for file in files:
+        if category.search(file) != [file]:
+            raise AssertionError()
+        if category.search(f'{file[:5]}*') != sorted(
+                f for f in files if f.startswith(file[:5])):
+            raise AssertionError()
+        if category.search(file[:-1] + '?') != [file]:
+            raise AssertionError()
+    if category.search('*') != sorted(files):
+        raise AssertionError()
+    if category.search(files[:2]) != sorted(files[:2]):
+        raise AssertionError()
+    if category.search('.*', regex=True) != sorted(files):
+        raise AssertionError()
+    if category.search(
+            [f'.*-{pattern}-.*' for pattern in patterns[:2]],
+            regex=True) != sorted(
+                f for f in files
+                if f'-{patterns[0]}-' in f or f'-{patterns[1]}-' in f):
+        raise AssertionError()
+    # the index follows modifications
+    category['aaa'] = dict(size=1, hash='x')
+    if 'aaa' not in category.search('a*'):
+        raise AssertionError()
+    del category['aaa']
+    if 'aaa' in category.search('a*'):
+        raise AssertionError()
+
+
 def test_repository():
     args = [random.randint(2, 7) for _ in range(3)]
     with RandomCatalogue(*args, mode=0) as (data, file):
@@ -142,6 +204,120 @@ def test_repository():
             raise AssertionError()
 
 
+def test_repository_digest():
+    args = [random.randint(2, 7) for _ in range(3)]
+    with RandomCatalogue(*args, mode=0) as (data, file):
+        repository = Repository(f'{file}.yaml', f'{file}.md5')
+    files = list(data['index'])
+    for file in files:
+        if repository.digest(file) != ('md5', data['index'][file]['hash']):
+            raise AssertionError()
+        with pytest.raises(LoadError):
+            repository.hash(file, 'sha256')
+    for algorithm in ('sha256', 'blake2b'):
+        repository.index[files[0]][algorithm] = randomizer(64)
+        if repository.hash(files[0], algorithm) != (
+                repository.index[files[0]][algorithm]):
+            raise AssertionError()
+    if repository.digest(files[0])[0] != 'blake2b':
+        raise AssertionError()
+    del repository.index[files[0]]['blake2b']
+    if repository.digest(files[0])[0] != 'md5':
+        raise AssertionError()
+
+
+def test_repository_members():
+    args = [random.randint(2, 7) for _ in range(3)]
+    with RandomCatalogue(*args, mode=0) as (data, file):
+        repository = Repository(f'{file}.yaml', f'{file}.md5')
+    container = list(data['containers'])[0]
+    if repository.members(container) != dict():
+        raise AssertionError()
+    members = {
+        file: data['index'][file] for file in list(data['index'])[:2]}
+    repository.containers[container]['members'] = members
+    if repository.members(container) != members:
+        raise AssertionError()
+    with pytest.raises(LoadError):
+        repository.members(list(data['index'])[0])
+
+
+def test_load_catalogue():
+    args = [random.randint(2, 7) for _ in range(3)]
+    with RandomCatalogue(*args, mode=0) as (data, file):
+        checksum = file_hash(f'{file}.yaml')
+        if load_catalogue(f'{file}.yaml', checksum, use_cache=False) != data:
+            raise AssertionError()
+        compiled = os.path.join(catalogue_cache_path(), f'{checksum}.json')
+        if os.path.exists(compiled):
+            raise AssertionError()
+        if load_catalogue(f'{file}.yaml', checksum) != data:
+            raise AssertionError()
+        if not os.path.exists(compiled):
+            raise AssertionError()
+    # the compiled catalogue is used without the YAML file
+    if load_catalogue(f'{file}.yaml', checksum) != data:
+        raise AssertionError()
+    os.remove(compiled)
+
+
+def test_repository_mirrors():
+    args = [random.randint(2, 7) for _ in range(3)]
+    with RandomCatalogue(*args, mode=0) as (data, file):
+        repository = Repository(f'{file}.yaml', f'{file}.md5')
+    if repository.mirrors.urls != [data['url']]:
+        raise AssertionError()
+    mirror = f'http://{randomizer(10)}.{randomizer(3)}/'
+    data['mirrors'] = [mirror]
+    with RandomCatalogue(*args, mode=0) as (_, file):
+        with open(f'{file}.yaml', 'w') as fh:
+            fh.write(dump(data))
+        repository = Repository(f'{file}.yaml')
+    if repository.mirrors.urls != [data['url'], mirror]:
+        raise AssertionError()
+    key = list(data['index'])[0]
+    if repository.mirrors_for(key) is not repository.mirrors:
+        raise AssertionError()
+    if repository.url_for(key, mirror=mirror) != f'{mirror}{key}':
+        raise AssertionError()
+    if mirror not in str(repository):
+        raise AssertionError()
+
+
+def test_repository_group():
+    args = [random.randint(2, 7) for _ in range(3)]
+    with RandomCatalogue(*args, mode=0) as (data, file):
+        first = Repository(f'{file}.yaml', f'{file}.md5')
+    with RandomCatalogue(*args, mode=0) as (other, file):
+        second = Repository(f'{file}.yaml', f'{file}.md5')
+    shared = list(data['index'])[0]
+    second.index[shared] = dict(size=1, hash=randomizer(32))
+    group = RepositoryGroup([first, second])
+    if len(group.search('*')) != (
+            len(data['index']) + len(data['containers'])
+            + len(other['index']) + len(other['containers'])):
+        raise AssertionError()
+    # the first repository takes precedence
+    if group.hash(shared) != data['index'][shared]['hash']:
+        raise AssertionError()
+    if group.owner(shared) is not first:
+        raise AssertionError()
+    for file in other['index']:
+        if group.owner(file) is not second:
+            raise AssertionError()
+        if group.url_for(file) != f'{other["url"]}/{file}':
+            raise AssertionError()
+    string = str(group)
+    if data['url'] not in string or other['url'] not in string:
+        raise AssertionError()
+    with pytest.raises(LoadError):
+        group.owner(shared[1:-1])
+    with pytest.raises(ValueError):
+        RepositoryGroup([])
+    with pytest.raises(TypeError):
+        RepositoryGroup([first, 'not-a-repository'])
+
+
 def test_repository_break():
     for mode in range(4):
         with RandomCatalogue(4, 3, 2, mode=mode + 1) as (data, file):
@@ -0,0 +1,158 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pytest
+from copy import copy
+from requests import HTTPError
+from yaml import dump
+from .. import default_repository as REPO
+from ..repository import Repository
+from ..transports import FileTransport
+from ..transports import Urllib3Transport
+from ..transports import get_transport
+from ..transports import is_local
+from ..transports import parse_range
+from ..transports import url_to_path
+from ..utils import download_file
+from ..utils import file_hash
+
+FILE = 'mdshare-test-00.txt'
+HASH = '5cbb04531c2e9fa7cc1e5d83195a2f81'
+DATA = bytes(range(256)) * 1000
+
+
+def make_local_repository(tmpdir, transport=None):
+    directory = os.path.join(tmpdir, 'repository')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'data.bin'), 'wb') as fh:
+        fh.write(DATA)
+    catalogue = os.path.join(tmpdir, 'catalogue.yaml')
+    with open(catalogue, 'w') as fh:
+        fh.write(dump(dict(
+            url=f'file://{directory}/',
+            index={'data.bin': dict(
+                size=len(DATA),
+                hash=file_hash(os.path.join(directory, 'data.bin')))},
+            containers=dict())))
+    return Repository(catalogue, use_cache=False, transport=transport)
+
+
+def test_urls():
+    for url, local in (
+            ('file:///data/x.npz', True), ('/data/x.npz', True),
+            ('http://host/x.npz', False), ('https://host/x.npz', False)):
+        if is_local(url) != local:
+            raise AssertionError()
+    if url_to_path('file:///data/x%20y.npz') != '/data/x y.npz':
+        raise AssertionError()
+    if url_to_path('/data/x.npz') != '/data/x.npz':
+        raise AssertionError()
+
+
+def test_parse_range():
+    for header, expected in (
+            ('bytes=0-', (0, 100)), ('bytes=10-19', (10, 20)),
+            ('bytes=90-200', (90, 100)), ('bytes=-10', (90, 100))):
+        if parse_range(header, 100) != expected:
+            raise AssertionError()
+    with pytest.raises(ValueError):
+        parse_range('lines=0-10', 100)
+
+
+def test_file_transport(tmpdir):
+    path = os.path.join(tmpdir, 'source')
+    with open(path, 'wb') as fh:
+        fh.write(DATA)
+    transport = FileTransport()
+    response = transport.get(f'file://{path}')
+    if response.status_code != 200:
+        raise AssertionError()
+    if b''.join(response.iter_content(1000)) != DATA:
+        raise AssertionError()
+    response = transport.get(path, headers={'Range': 'bytes=100-'})
+    if response.status_code != 206:
+        raise AssertionError()
+    if b''.join(response.iter_content(1000)) != DATA[100:]:
+        raise AssertionError()
+    if transport.get(path, headers={'Range': 'bytes=10-19'}).headers[
+            'Content-Length'] != '10':
+        raise AssertionError()
+    if transport.head(path).headers['Content-Length'] != str(len(DATA)):
+        raise AssertionError()
+    with pytest.raises(HTTPError):
+        transport.get(path + '-not-a-file').raise_for_status()
+
+
+def test_file_transport_copy(tmpdir):
+    path = os.path.join(tmpdir, 'source')
+    with open(path, 'wb') as fh:
+        fh.write(DATA)
+    for link in ('copy', 'copy_file_range', 'sendfile', 'hardlink', 'auto'):
+        if link != 'auto' and not hasattr(os, link) and link not in (
+                'copy', 'hardlink'):
+            continue
+        target = os.path.join(tmpdir, link)
+        with open(target, 'wb') as fh:
+            fh.write(DATA[:1000] + b'garbage')
+        mode = FileTransport(link=link).copy(path, target, offset=1000)
+        if link != 'auto' and mode != link:
+            raise AssertionError()
+        with open(target, 'rb') as fh:
+            if fh.read() != DATA:
+                raise AssertionError()
+    if os.stat(os.path.join(tmpdir, 'hardlink')).st_nlink != 2:
+        raise AssertionError()
+
+
+def test_file_transport_break(tmpdir):
+    with pytest.raises(ValueError):
+        FileTransport(link='teleport')
+    with pytest.raises(HTTPError):
+        FileTransport().copy(
+            os.path.join(tmpdir, 'not-a-file'), os.path.join(tmpdir, 'x'))
+    if Urllib3Transport().can_copy('http://host/x'):
+        raise AssertionError()
+    if not Urllib3Transport().can_copy(os.path.join(tmpdir, 'x')):
+        raise AssertionError()
+    with pytest.raises(NotImplementedError):
+        Urllib3Transport().copy('http://host/x', os.path.join(tmpdir, 'x'))
+    with pytest.raises(ValueError):
+        get_transport('carrier-pigeon')
+
+
+def test_download_file_local(tmpdir):
+    for transport in (None, 'file', FileTransport(link='hardlink')):
+        repository = make_local_repository(
+            os.path.join(tmpdir, str(id(transport))), transport=transport)
+        local_path = download_file(
+            repository, 'data.bin', os.path.join(tmpdir, 'data.bin'),
+            segments=4)
+        if file_hash(local_path) != repository.hash('data.bin'):
+            raise AssertionError()
+        os.remove(local_path)
+
+
+def test_download_file_urllib3():
+    repository = copy(REPO)
+    repository.transport = get_transport('urllib3')
+    for segments in (1, 3):
+        local_path = download_file(
+            repository, FILE, f'{FILE}.urllib3', segments=segments)
+        if file_hash(local_path) != HASH:
+            raise AssertionError()
+        os.remove(local_path)
@@ -15,17 +15,30 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
+import hashlib
+import gzip
 import string
 import random
+import tarfile
 import pytest
 import os
+from copy import copy
 from .. import default_repository as REPO
 from ..utils import LoadError
 from ..utils import file_hash
+from ..manifest import Manifest
+from ..mirrors import Mirrors
 from ..utils import url_join
 from ..utils import download_file
+from ..utils import download_segments
 from ..utils import attempt_to_download_file
 from ..utils import download_wrapper
+from ..utils import extract_container
+from ..utils import compress_blocks
+from ..utils import BlockReader
+from ..utils import download_and_extract
+from ..utils import VerifiedStream
 
 
 REPO_URL = REPO.url.rstrip('/')
@@ -46,9 +59,19 @@ def file_check(file):
         raise AssertionError()
 
 
+def teardown_module():
+    manifest = Manifest('.')
+    if os.path.exists(manifest.path):
+        os.remove(manifest.path)
+
+
 def test_file_hash():
     if file_hash('LICENSE') != 'bb3ca60759f3202f1ae42e3519cd06bc':
         raise AssertionError()
+    if file_hash('LICENSE', algorithm='sha256') != (
+            'ea8af5e789cb2d4e9b10bce3874982ad'
+            'e163b749b6bfbdb32e2df21c4d106de1'):
+        raise AssertionError()
 
 
 def test_file_hash_break():
@@ -56,6 +79,8 @@ def test_file_hash_break():
         file_hash(None)
     with pytest.raises(FileNotFoundError):
         file_hash('THIS IS NOT A FILE')
+    with pytest.raises(ValueError):
+        file_hash('LICENSE', algorithm='not-an-algorithm')
 
 
 def test_url_join():
@@ -87,6 +112,73 @@ def test_url_join_break():
 
 def test_download_file():
     file_check(download_file(REPO, FILE, local_file()))
+    file_check(download_file(REPO, FILE, local_file(), segments=4))
+
+
+def test_download_segments():
+    local_path = local_file()
+    download_segments(REPO, FILE, local_path, REPO.size(FILE), 3)
+    file_check(local_path)
+
+
+def test_download_file_resume():
+    local_path = download_file(REPO, FILE, local_file())
+    with open(local_path, 'rb') as fh:
+        data = fh.read()
+    os.remove(local_path)
+    with open(f'{local_path}.part', 'wb') as fh:
+        fh.write(data[:len(data) // 2])
+    file_check(download_file(REPO, FILE, local_path))
+    if os.path.exists(f'{local_path}.part'):
+        raise AssertionError()
+
+
+def test_download_file_resume_stale():
+    local_path = local_file()
+    with open(f'{local_path}.part', 'wb') as fh:
+        fh.write(b'garbage')
+    file_check(download_file(REPO, FILE, local_path))
+    if os.path.exists(f'{local_path}.part'):
+        raise AssertionError()
+
+
+def test_download_file_failover():
+    repository = copy(REPO)
+    dead = 'http://127.0.0.1:1/'
+    repository.mirrors = Mirrors([dead, REPO.url])
+    # make the dead mirror look fast so that it is tried first
+    repository.mirrors.record(dead, 10**9, 1.0)
+    for segments in (1, 3):
+        local_path = local_file()
+        if segments == 1:
+            download_file(repository, FILE, local_path)
+        else:
+            download_segments(
+                repository, FILE, local_path, REPO.size(FILE), segments)
+        file_check(local_path)
+        if repository.mirrors.ranked()[-1] != dead:
+            raise AssertionError()
+
+
+def test_download_segments_failover(monkeypatch):
+    from .. import utils
+    # let the small test file be split into segments
+    monkeypatch.setattr(utils, 'MIN_SEGMENT_SIZE', 1)
+    dead = 'http://127.0.0.1:1/'
+    for download in ('segments', 'attempt'):
+        repository = copy(REPO)
+        repository.mirrors = Mirrors([dead, REPO.url])
+        repository.mirrors.record(dead, 10**9, 1.0)
+        local_path = local_file()
+        if download == 'segments':
+            download_segments(
+                repository, FILE, local_path, REPO.size(FILE), 3)
+        else:
+            attempt_to_download_file(
+                repository, FILE, local_path, segments=3)
+        file_check(local_path)
+        if dead not in repository.mirrors.failures:
+            raise AssertionError()
 
 
 def test_download_file_break():
@@ -122,6 +214,103 @@ def test_attempt_to_download_file_break():
             REPO, 'not-an-existing-file', local_file())
 
 
+def test_extract_container(tmpdir):
+    for name in ('a.txt', 'b.txt'):
+        with open(os.path.join(tmpdir, name), 'w') as fh:
+            fh.write(name)
+    archive = os.path.join(tmpdir, 'container.tar.gz')
+    with tarfile.open(archive, 'w:gz') as fh:
+        for name in ('a.txt', 'b.txt'):
+            fh.add(os.path.join(tmpdir, name), arcname=name)
+        fh.add(os.path.join(tmpdir, 'a.txt'), arcname='sub/a.txt')
+    target = os.path.join(tmpdir, 'target')
+    os.mkdir(target)
+    paths = extract_container(archive, target)
+    if sorted(os.path.basename(path) for path in paths) != ['a.txt', 'b.txt']:
+        raise AssertionError()
+    if sorted(os.listdir(target)) != ['a.txt', 'b.txt']:
+        raise AssertionError()
+    # members are hashed while written, regardless of the catalogue digest
+    checksums = dict()
+    extract_container(
+        archive, target, members={'a.txt': dict(hash='wrong')},
+        checksums=checksums)
+    if checksums != {'a.txt': ('md5', file_hash(os.path.join(
+            tmpdir, 'a.txt')))}:
+        raise AssertionError()
+    if file_hash(os.path.join(target, 'b.txt')) != file_hash(
+            os.path.join(tmpdir, 'b.txt')):
+        raise AssertionError()
+
+
+def test_compress_blocks():
+    data = os.urandom(100000) + b'mdshare' * 10000
+    compressed = io.BytesIO()
+    offsets = compress_blocks(io.BytesIO(data), compressed, 7000)
+    if len(offsets) != (len(data) + 6999) // 7000 or offsets[0] != 0:
+        raise AssertionError()
+    compressed = compressed.getvalue()
+    if gzip.decompress(compressed) != data:
+        raise AssertionError()
+    with BlockReader(
+            io.BytesIO(compressed), offsets, len(compressed),
+            max_workers=3) as reader:
+        chunks = []
+        while True:
+            chunk = reader.read(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    if b''.join(chunks) != data:
+        raise AssertionError()
+    # closing early drops the blocks which were not read
+    reader = BlockReader(
+        io.BytesIO(compressed), offsets, len(compressed), max_workers=1)
+    if reader.read(10) != data[:10]:
+        raise AssertionError()
+    reader.close()
+    if reader._pending:
+        raise AssertionError()
+
+
+def test_extract_container_blocks(tmpdir):
+    source = os.path.join(tmpdir, 'source')
+    target = os.path.join(tmpdir, 'target')
+    for directory in (source, target):
+        os.mkdir(directory)
+    for name in ('a.txt', 'b.txt'):
+        with open(os.path.join(source, name), 'w') as fh:
+            fh.write(name * 1000)
+    tar = io.BytesIO()
+    with tarfile.open(fileobj=tar, mode='w') as fh:
+        for name in ('a.txt', 'b.txt'):
+            fh.add(os.path.join(source, name), arcname=name)
+    tar.seek(0)
+    archive = os.path.join(tmpdir, 'container.tar.gz')
+    with open(archive, 'wb') as fh:
+        blocks = compress_blocks(tar, fh, 1024)
+    paths = extract_container(archive, target, blocks=blocks)
+    for path in paths:
+        name = os.path.basename(path)
+        if file_hash(path) != file_hash(os.path.join(source, name)):
+            raise AssertionError()
+    if len(paths) != 2:
+        raise AssertionError()
+
+
+def test_download_and_extract(tmpdir):
+    checksums = dict()
+    paths = download_and_extract(
+        REPO, 'mdshare-test.tar.gz', tmpdir, checksums=checksums)
+    if len(paths) != 1:
+        raise AssertionError()
+    if checksums != {FILE: ('md5', HASH)}:
+        raise AssertionError()
+    file_check(paths[0])
+    if os.listdir(tmpdir):
+        raise AssertionError()
+
+
 def test_download_wrapper():
     file_check(download_wrapper(REPO, FILE))
     file_check(download_wrapper(REPO, FILE, max_attempts=10))
@@ -132,6 +321,16 @@ def test_download_wrapper():
     file_check(download_wrapper(REPO, FILE, force=True))
 
 
+def test_download_wrapper_verify():
+    download_wrapper(REPO, FILE)
+    with open(FILE, 'w') as fh:
+        fh.write('nonsense content')
+    for verify in ('fast', 'full'):
+        if file_hash(download_wrapper(REPO, FILE, verify=verify)) != HASH:
+            raise AssertionError()
+    file_check(download_wrapper(REPO, FILE, verify='fast'))
+
+
 def test_download_wrapper_break():
     with pytest.raises(TypeError):
         download_wrapper(REPO, None)
@@ -145,3 +344,26 @@ def test_download_wrapper_break():
         download_wrapper('not-a-repository', FILE)
     with pytest.raises(LoadError):
         download_wrapper(REPO, FILE, max_attempts=0)
+    with pytest.raises(ValueError):
+        download_wrapper(REPO, FILE, verify='partial')
+
+
+def test_verified_stream():
+    with VerifiedStream(REPO, FILE) as stream:
+        head = stream.read(10)
+        # a new transfer continues at the current position
+        stream._chunks = None
+        data = head + stream.read()
+    if hashlib.md5(data).hexdigest() != HASH or not stream.verified:
+        raise AssertionError()
+    if stream.read() != b'':
+        raise AssertionError()
+
+
+def test_verified_stream_break():
+    repository = copy(REPO)
+    repository.index = type(REPO.index)(REPO.index)
+    repository.index[FILE] = dict(REPO.index[FILE], hash='0' * 32)
+    stream = VerifiedStream(repository, FILE)
+    with pytest.raises(LoadError):
+        stream.read()
@@ -0,0 +1,376 @@
+# This file is part of the markovmodel/mdshare project.
+# Copyright (C) 2017-2019 Computational Molecular Biology Group,
+# Freie Universitaet Berlin (GER)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Transports fetch repository files for the download functions.
+
+All transports return responses with the subset of the requests.Response
+interface used by mdshare (status_code, iter_content, raise_for_status,
+close) and report errors as requests exceptions, so that retries and
+mirror failover work the same for every backend.
+"""
+
+import os
+import re
+import logging
+from urllib.parse import unquote, urlparse
+
+COPY_CHUNK_SIZE = 2**30
+COPY_MODES = ('reflink', 'hardlink', 'copy_file_range', 'sendfile', 'copy')
+
+
+def is_local(url):
+    """Check whether a URL refers to the local file system."""
+    return url.startswith('file:') or '://' not in url
+
+
+def url_to_path(url):
+    """Return the local path of a file:// URL or plain path."""
+    if url.startswith('file:'):
+        return unquote(urlparse(url).path)
+    return url
+
+
+def parse_range(header, size):
+    """Return the (start, stop) bytes requested by a Range header."""
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if match is None:
+        raise ValueError(f'unsupported Range header: {header}')
+    start, end = match.groups()
+    if start == '':
+        return max(0, size - int(end)), size
+    stop = size if end == '' else min(size, int(end) + 1)
+    return int(start), stop
+
+
+def copy_bytes(mode, source, target, offset, count):
+    """Copy bytes between two open files.
+
+    Arguments:
+        mode (str): copy_file_range or sendfile to copy inside the kernel
+            (the former may share extents on copy-on-write file systems),
+            or copy for a buffered copy
+        source (file object): file opened for reading
+        target (file object): file opened for writing at its end
+        offset (int): position of the first byte in source
+        count (int): number of bytes to copy
+    """
+    stop = offset + count
+    if mode == 'copy':
+        source.seek(offset)
+    while offset < stop:
+        n = min(COPY_CHUNK_SIZE, stop - offset)
+        if mode == 'copy_file_range':
+            copied = os.copy_file_range(
+                source.fileno(), target.fileno(), n, offset)
+        elif mode == 'sendfile':
+            copied = os.sendfile(target.fileno(), source.fileno(), offset, n)
+        else:
+            copied = target.write(source.read(n))
+        if copied == 0:
+            raise OSError(f'{source.name} ended at byte {offset}')
+        offset += copied
+
+
+class FileResponse(object):
+    """Streamed response for a local file.
+
+    Arguments:
+        path (str): path of the local file
+        status_code (int): HTTP-like status of the request
+        start (int): first byte to be read
+        stop (int): end of the byte range to be read
+    """
+    def __init__(self, path, status_code, start=0, stop=0):
+        self.path = path
+        self.status_code = status_code
+        self.start = start
+        self.stop = stop
+        self.headers = {'Content-Length': str(stop - start)}
+
+    def iter_content(self, chunk_size=1):
+        from requests import ConnectionError
+        position = self.start
+        try:
+            with open(self.path, 'rb') as fh:
+                fh.seek(position)
+                while position < self.stop:
+                    data = fh.read(min(chunk_size, self.stop - position))
+                    if not data:
+                        raise ConnectionError(
+                            f'{self.path} ended at byte {position}')
+                    position += len(data)
+                    yield data
+        except OSError as e:
+            raise ConnectionError(f'cannot read {self.path}: {e}')
+
+    def raise_for_status(self):
+        from requests import HTTPError
+        if self.status_code >= 400:
+            raise HTTPError(
+                f'{self.status_code} error for {self.path}', response=self)
+
+    def close(self):
+        pass
+
+
+class Transport(object):
+    """Base class of all transports.
+
+    Local URLs (file:// or plain paths) are always served by a
+    FileTransport, so repositories may mix local and remote mirrors.
+    """
+    def __init__(self):
+        self._local = None
+
+    def _get_local(self):
+        if self._local is None:
+            self._local = FileTransport()
+        return self._local
+
+    def get(self, url, headers=None):
+        """Request a file as a streamed response.
+
+        Arguments:
+            url (str): URL of the file
+            headers (dict): request headers, e.g., Range
+        """
+        return self._get_local().get(url, headers=headers)
+
+    def head(self, url, timeout=None):
+        """Request the headers of a file."""
+        return self._get_local().head(url, timeout=timeout)
+
+    def can_copy(self, url):
+        """Check whether copy() supports a URL."""
+        return is_local(url)
+
+    def copy(self, url, local_path, offset=0):
+        """Copy a file (from offset on) without streaming it through Python.
+
+        Only URLs for which can_copy() holds are supported; others raise
+        NotImplementedError. Returns the method used for copying.
+        """
+        if not self.can_copy(url):
+            raise NotImplementedError('only local files can be copied')
+        return self._get_local().copy(url, local_path, offset=offset)
+
+    def set_pool_maxsize(self, pool_maxsize):
+        """Allow for at least pool_maxsize concurrent connections."""
+        pass
+
+
+class FileTransport(Transport):
+    """Transport for repositories on a local or network file system.
+
+    Arguments:
+        link (str): how copy() materializes whole files: reflink,
+            hardlink, copy_file_range, sendfile, copy, or auto to try
+            reflink, copy_file_range, sendfile, and copy in that order;
+            hardlinks share the repository's inode and are opt-in
+    """
+    def __init__(self, link='auto'):
+        super(FileTransport, self).__init__()
+        if link != 'auto' and link not in COPY_MODES:
+            raise ValueError(f'unsupported link mode: {link}')
+        self.link = link
+
+    def _get_local(self):
+        return self
+
+    def _stat(self, url):
+        path = url_to_path(url)
+        try:
+            return path, os.stat(path).st_size
+        except FileNotFoundError:
+            FileResponse(path, 404).raise_for_status()
+        except OSError as e:
+            from requests import ConnectionError
+            raise ConnectionError(f'cannot access {path}: {e}')
+
+    def get(self, url, headers=None):
+        path, size = self._stat(url)
+        header = (headers or dict()).get('Range')
+        if header is None:
+            return FileResponse(path, 200, 0, size)
+        start, stop = parse_range(header, size)
+        if start >= size:
+            return FileResponse(path, 416)
+        return FileResponse(path, 206, start, stop)
+
+    def head(self, url, timeout=None):
+        path, size = self._stat(url)
+        return FileResponse(path, 200, 0, size)
+
+    def copy(self, url, local_path, offset=0):
+        path, size = self._stat(url)
+        if self.link == 'auto':
+            modes = ('reflink', 'copy_file_range', 'sendfile', 'copy')
+        else:
+            modes = (self.link,)
+        for mode in modes:
+            try:
+                self._copy(mode, path, local_path, offset, size)
+            except (OSError, AttributeError) as e:
+                # AttributeError: syscall not available on this platform
+                logging.debug(f'cannot {mode} {path} to {local_path}: {e}')
+                if mode == modes[-1]:
+                    raise
+                continue
+            logging.debug(f'{mode} {path} to {local_path}')
+            return mode
+
+    def _copy(self, mode, path, local_path, offset, size):
+        if mode in ('reflink', 'hardlink'):
+            from .cache import reflink
+            # links always provide the whole file, regardless of offset
+            tmp = f'{local_path}.{mode}'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            (reflink if mode == 'reflink' else os.link)(path, tmp)
+            os.replace(tmp, local_path)
+            return
+        with open(path, 'rb') as source, open(
+                local_path, 'r+b' if offset else 'wb') as target:
+            target.seek(offset)
+            target.truncate()
+            copy_bytes(mode, source, target, offset, size - offset)
+
+
+class RequestsTransport(Transport):
+    """HTTP(S) transport based on a requests session."""
+    def __init__(self):
+        super(RequestsTransport, self).__init__()
+        self._session = None
+        self._pool_maxsize = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.session()
+        return self._session
+
+    def get(self, url, headers=None):
+        if is_local(url):
+            return super(RequestsTransport, self).get(url, headers=headers)
+        return self.session.get(url, stream=True, headers=headers)
+
+    def head(self, url, timeout=None):
+        if is_local(url):
+            return super(RequestsTransport, self).head(url, timeout=timeout)
+        return self.session.head(url, timeout=timeout)
+
+    def set_pool_maxsize(self, pool_maxsize):
+        import requests
+        if self._pool_maxsize is None or pool_maxsize > self._pool_maxsize:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=pool_maxsize)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self._pool_maxsize = pool_maxsize
+
+
+class Urllib3Response(object):
+    """Wrapper giving a urllib3 response the interface of requests."""
+    def __init__(self, url, response):
+        self.url = url
+        self.raw = response
+        self.status_code = response.status
+        self.headers = response.headers
+
+    def iter_content(self, chunk_size=1):
+        from urllib3.exceptions import HTTPError as Urllib3Error
+        from requests import ConnectionError
+        try:
+            yield from self.raw.stream(chunk_size)
+        except Urllib3Error as e:
+            raise ConnectionError(e)
+        finally:
+            self.raw.release_conn()
+
+    def raise_for_status(self):
+        from requests import HTTPError
+        if self.status_code >= 400:
+            raise HTTPError(
+                f'{self.status_code} error for url: {self.url}',
+                response=self)
+
+    def close(self):
+        self.raw.release_conn()
+
+
+class Urllib3Transport(Transport):
+    """HTTP(S) transport using a bare urllib3 pool manager, which avoids
+    the per-request overhead of a requests session."""
+    def __init__(self):
+        super(Urllib3Transport, self).__init__()
+        self._pool = None
+        self._pool_maxsize = 10
+
+    def _request(self, method, url, headers=None, timeout=None):
+        import urllib3
+        from requests import ConnectionError
+        if self._pool is None:
+            self._pool = urllib3.PoolManager(maxsize=self._pool_maxsize)
+        try:
+            response = self._pool.request(
+                method, url, headers=headers, timeout=timeout,
+                preload_content=False, redirect=True)
+        except urllib3.exceptions.HTTPError as e:
+            raise ConnectionError(e)
+        return Urllib3Response(url, response)
+
+    def get(self, url, headers=None):
+        if is_local(url):
+            return super(Urllib3Transport, self).get(url, headers=headers)
+        return self._request('GET', url, headers=headers)
+
+    def head(self, url, timeout=None):
+        if is_local(url):
+            return super(Urllib3Transport, self).head(url, timeout=timeout)
+        response = self._request('HEAD', url, timeout=timeout)
+        response.close()
+        return response
+
+    def set_pool_maxsize(self, pool_maxsize):
+        if pool_maxsize > self._pool_maxsize:
+            self._pool_maxsize = pool_maxsize
+            if self._pool is not None:
+                self._pool.connection_pool_kw['maxsize'] = pool_maxsize
+                self._pool.clear()
+
+
+TRANSPORTS = dict(
+    requests=RequestsTransport,
+    urllib3=Urllib3Transport,
+    file=FileTransport)
+
+
+def get_transport(transport=None):
+    """Return a transport instance.
+
+    Arguments:
+        transport (str or Transport): name of a transport in TRANSPORTS,
+            a Transport instance, or None for requests
+    """
+    if transport is None:
+        transport = 'requests'
+    if isinstance(transport, Transport):
+        return transport
+    if transport not in TRANSPORTS:
+        raise ValueError(f'unsupported transport: {transport}')
+    return TRANSPORTS[transport]()
@@ -17,9 +17,27 @@
 
 import os
 import sys
+import time
+import zlib
+import shutil
 import logging
-from requests import HTTPError
-from hashlib import md5
+import tarfile
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from functools import partial
+from tempfile import mkdtemp
+from threading import Lock
+import hashlib
+from .transports import is_local
+from .bandwidth import throttle
+from .metrics import measure, phase
+
+
+BLOCKSIZE = 1024 * 8
+MIN_SEGMENT_SIZE = 1024 * 1024 * 8
+# digests which a catalogue entry may carry, cheapest to verify first;
+# md5 is stored under the 'hash' key
+DIGESTS = ('blake2b', 'md5', 'sha256')
 
 
 class LoadError(KeyError):
@@ -32,21 +50,65 @@ class LoadError(KeyError):
         return f'{self.file} [{self.message}]'
 
 
-def file_hash(file, chunk_size=65536):
-    """Compute the MD5 hash of a file.
+def select_digest(metadata):
+    """Return the cheapest (algorithm, hexdigest) pair of a catalogue entry.
+
+    Arguments:
+        metadata (dict): catalogue entry with at least one digest
+    """
+    for algorithm in DIGESTS:
+        field = 'hash' if algorithm == 'md5' else algorithm
+        if field in metadata:
+            return algorithm, metadata[field]
+    return None
+
+
+def update_hash(hash_, file, chunk_size=65536):
+    """Feed the content of a file into a hash object.
 
     Arguments:
+        hash_ (hashlib hash object): hash object to be updated
         file (str): path of the file to be hashed
         chunk_size (int): size of chunks to read
     """
-    hash_ = md5()
     with open(file, 'rb') as fh:
         while True:
             data = fh.read(chunk_size)
             if not data:
                 break
             hash_.update(data)
-    return hash_.hexdigest()
+    return hash_
+
+
+def file_hash(file, chunk_size=65536, algorithm='md5'):
+    """Compute the hash of a file.
+
+    Arguments:
+        file (str): path of the file to be hashed
+        chunk_size (int): size of chunks to read
+        algorithm (str): name of the hashlib algorithm
+    """
+    hash_ = hashlib.new(algorithm)
+    return update_hash(hash_, file, chunk_size=chunk_size).hexdigest()
+
+
+def interruptible(callback, stop):
+    """Wrap a progress callback to abort the download once stop is set.
+
+    Downloads report their progress after every chunk, so the returned
+    callback raises CancelledError between chunks. The partial download
+    is kept and resumed by the next call.
+
+    Arguments:
+        callback (callable): callback function, may be None
+        stop (threading.Event): signals that the download should end
+    """
+    def check(n, blocksize=1):
+        if stop.is_set():
+            raise CancelledError('download stopped')
+        if callback is not None:
+            callback(n, blocksize)
+    return check
 
 
 def url_join(repository_url, file):
@@ -59,84 +121,785 @@ def url_join(repository_url, file):
     return f'{repository_url.rstrip("/")}/{file.lstrip("/")}'
 
 
-def download_file(repository, file, local_path, callback=None):
-    """Download a file.
+def write_stream(
+        response, local_path, callback=None, offset=0, hash_=None,
+        metrics=None):
+    """Write a streamed response into a file.
+
+    Arguments:
+        response (requests.Response): streamed response object
+        local_path (str): local path where the file should be saved
+        callback (callable): callback function
+        offset (int): number of bytes already present in the file
+        hash_ (hashlib hash object): hash object fed with the written data
+        metrics (FileMetrics): records the transfer
+    """
+    downloaded = offset
+    with open(local_path, 'ab' if offset else 'wb') as fh:
+        for data in measure(
+                throttle(response.iter_content(BLOCKSIZE)), metrics):
+            fh.write(data)
+            if hash_ is not None:
+                hash_.update(data)
+            downloaded += len(data)
+            if callback is not None:
+                callback(downloaded, 1)
+
+
+def open_stream(repository, file, headers=None, metrics=None):
+    """Request a file from the first mirror which responds.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the file in the repository
+        headers (dict): additional request headers
+        metrics (FileMetrics): records the connection and the mirror
+
+    Returns the mirror's base URL and the streamed response.
+    """
+    from requests import RequestException
+    connection = repository._get_connection()
+    mirrors = repository.mirrors_for(file)
+    error = None
+    for mirror in mirrors.ranked(connection):
+        try:
+            with phase(metrics, 'connect'):
+                response = connection.get(
+                    repository.url_for(file, mirror=mirror), headers=headers)
+            response.raise_for_status()
+            if metrics is not None:
+                metrics.mirror = mirror
+            return mirror, response
+        except RequestException as e:
+            logging.debug(f'<{mirror}> cannot provide {file}: {e}')
+            mirrors.failed(mirror)
+            error = e
+    raise error
+
+
+def download_segments(
+        repository, file, local_path, size, segments, callback=None):
+    """Download a file as concurrent byte ranges into a preallocated file.
+
+    The ranges are spread over all mirrors; a range whose transfer fails
+    is continued on the next mirror. Falls back to a single stream if the
+    server ignores the Range header.
 
     Arguments:
         repository (Repository): repository object
         file (str): name of the file in the repository
         local_path (str): local path where the file should be saved
+        size (int): size of the file in bytes
+        segments (int): number of concurrent byte ranges
         callback (callable): callback function
     """
+    from requests import HTTPError, RequestException
+    connection = repository._get_connection(pool_maxsize=segments)
+    mirrors = repository.mirrors_for(file)
+    ranked = mirrors.ranked(connection)
+    bounds = [size * i // segments for i in range(segments + 1)]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    lock = Lock()
+    downloaded = 0
+
+    def get(mirror, start, stop):
+        return connection.get(
+            repository.url_for(file, mirror=mirror),
+            headers={'Range': f'bytes={start}-{stop - 1}'})
+
+    def segment(index, start, stop, response=None):
+        nonlocal downloaded
+        # each range starts on its own mirror and fails over to the others;
+        # a probe response belongs to the mirror which answered the probe
+        if response is None:
+            shift = index % len(ranked)
+        else:
+            shift = ranked.index(probed)
+        candidates = ranked[shift:] + ranked[:shift]
+        error = None
+        for mirror in candidates:
+            began, received = time.monotonic(), 0
+            try:
+                if response is None:
+                    response = get(mirror, start, stop)
+                if response.status_code != 206:
+                    response.raise_for_status()
+                    raise HTTPError(
+                        f'expected partial content for bytes'
+                        f' {start}-{stop - 1},'
+                        f' got status {response.status_code}',
+                        response=response)
+                with open(local_path, 'r+b') as fh:
+                    fh.seek(start)
+                    for data in throttle(response.iter_content(BLOCKSIZE)):
+                        fh.write(data)
+                        start += len(data)
+                        received += len(data)
+                        if callback is not None:
+                            with lock:
+                                downloaded += len(data)
+                                callback(downloaded, 1)
+                return
+            except RequestException as e:
+                logging.debug(f'<{mirror}> failed at byte {start}: {e}')
+                mirrors.failed(mirror)
+                error = e
+            finally:
+                mirrors.record(mirror, received, time.monotonic() - began)
+                response = None
+        raise error
+
+    # the first range probes the mirrors in rank order for Range support
+    response, error = None, None
+    for probed in ranked:
+        try:
+            response = get(probed, *ranges[0])
+            response.raise_for_status()
+            break
+        except RequestException as e:
+            logging.debug(f'<{probed}> cannot provide {file}: {e}')
+            mirrors.failed(probed)
+            error, response = e, None
+    if response is None:
+        raise error
+    if response.status_code == 200:
+        logging.debug(
+            f'<{probed}> ignores Range ... single stream download')
+        return write_stream(response, local_path, callback=callback)
+    with open(local_path, 'wb') as fh:
+        fh.truncate(size)
+    try:
+        with ThreadPoolExecutor(max_workers=segments - 1) as executor:
+            futures = [
+                executor.submit(segment, index, *r)
+                for index, r in enumerate(ranges) if index > 0]
+            segment(0, *ranges[0], response=response)
+            for future in futures:
+                future.result()
+    except BaseException:
+        # the file has holes, so it cannot be resumed
+        os.remove(local_path)
+        raise
+
+
+def download_stream(
+        repository, file, part_path, offset, hash_, callback=None,
+        metrics=None):
+    """Append a file to a .part file, failing over between mirrors.
+
+    Local files are copied by the transport without passing through
+    Python. If a transfer breaks, the next mirror continues at the current
+    end of the .part file.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the file in the repository
+        part_path (str): local path of the partial download
+        offset (int): number of bytes already present in part_path
+        hash_ (hashlib hash object): hash of the first offset bytes
+        callback (callable): callback function
+        metrics (FileMetrics): records the phases of the download
+
+    Returns the hash object fed with the complete file.
+    """
+    from requests import RequestException
+    connection = repository._get_connection()
+    mirrors = repository.mirrors_for(file)
+    error = None
+    for mirror in mirrors.ranked(connection):
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+        url = repository.url_for(file, mirror=mirror)
+        began, start = time.monotonic(), offset
+        if metrics is not None:
+            metrics.mirror = mirror
+        try:
+            if connection.can_copy(url):
+                with phase(metrics, 'transfer'):
+                    connection.copy(url, part_path, offset=offset)
+                if metrics is not None:
+                    metrics.received(os.path.getsize(part_path) - offset)
+                # copied data bypasses write_stream and must be hashed
+                with phase(metrics, 'hash'):
+                    hash_ = update_hash(hashlib.new(hash_.name), part_path)
+                if callback is not None:
+                    callback(os.path.getsize(part_path), 1)
+                return hash_
+            with phase(metrics, 'connect'):
+                response = connection.get(url, headers=headers)
+            response.raise_for_status()
+            if offset > 0 and response.status_code != 206:
+                logging.debug(f'cannot resume {part_path} ... restarting')
+                offset = start = 0
+                hash_ = hashlib.new(hash_.name)
+            elif offset > 0:
+                logging.debug(f'resuming {part_path} at byte {offset}')
+            write_stream(
+                response, part_path, callback=callback, offset=offset,
+                hash_=hash_, metrics=metrics)
+            return hash_
+        except RequestException as e:
+            logging.debug(f'<{mirror}> cannot provide {file}: {e}')
+            mirrors.failed(mirror)
+            error = e
+        finally:
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+            mirrors.record(mirror, offset - start, time.monotonic() - began)
+    raise error
+
+
+def download_file(
+        repository, file, local_path, callback=None, segments=1,
+        metrics=None):
+    """Download a file via a .part file which is resumed if it exists.
+
+    A resumed download which fails the checksum (e.g., a stale .part file
+    from an older version of the file) is restarted once from byte 0.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the file in the repository
+        local_path (str): local path where the file should be saved
+        callback (callable): callback function
+        segments (int): number of concurrent byte ranges for large files
+        metrics (FileMetrics): records the phases of the download
+    """
     location, metadata = repository.lookup(file)
+    algorithm, expected = repository.digest(file)
     logging.debug(
-        f'Repository::{location}::{file} has checksum {metadata["hash"]}'
-        f' and size {metadata["size"]}')
+        f'Repository::{location}::{file} has {algorithm} checksum'
+        f' {expected} and size {metadata["size"]}')
     logging.debug(
-        f'From <{repository.url}> download <{file}> to <{local_path}>')
-    response = repository._get_connection().get(
-        url_join(repository.url, file),
-        stream=True)
-    blocksize = 1024 * 8
-    with open(local_path, 'wb') as fh:
-        for i, data in enumerate(response.iter_content(blocksize)):
-            fh.write(data)
-            if callback is not None:
-                callback(i, blocksize)
-    checksum = file_hash(local_path)
-    logging.debug(f'Loaded file {local_path} has {checksum}')
-    if checksum != metadata['hash']:
+        f'From <{repository.url_for(file)}> download to <{local_path}>')
+    if os.path.isdir(local_path):
+        raise IsADirectoryError(f'{local_path} is a directory')
+    size = metadata['size']
+    part_path = f'{local_path}.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size:
+        os.remove(part_path)
+        offset = 0
+    segments = min(segments, size // MIN_SEGMENT_SIZE)
+    if is_local(repository.url_for(file)):
+        # local files are copied at once
+        segments = 1
+    hash_ = hashlib.new(algorithm)
+    if metrics is not None:
+        metrics.source = 'network'
+    if offset == size:
+        logging.debug(f'{part_path} is complete ... skipping download')
+        with phase(metrics, 'hash'):
+            update_hash(hash_, part_path)
+    elif offset == 0 and segments > 1:
+        # concurrent ranges are timed as a whole
+        with phase(metrics, 'transfer'):
+            download_segments(
+                repository, file, part_path, size, segments,
+                callback=callback)
+        if metrics is not None:
+            metrics.received(size)
+        # segments arrive out of order and are hashed afterwards
+        with phase(metrics, 'hash'):
+            update_hash(hash_, part_path)
+    else:
+        if offset > 0:
+            with phase(metrics, 'hash'):
+                update_hash(hash_, part_path)
+        hash_ = download_stream(
+            repository, file, part_path, offset, hash_, callback=callback,
+            metrics=metrics)
+    checksum = hash_.hexdigest()
+    logging.debug(f'Loaded file {part_path} has {algorithm} {checksum}')
+    if checksum != expected:
+        os.remove(part_path)
+        if offset > 0:
+            logging.debug(f'resumed {part_path} is invalid ... restarting')
+            return download_file(
+                repository, file, local_path, callback=callback,
+                segments=segments, metrics=metrics)
         raise LoadError(file, 'checksum test failed')
+    os.replace(part_path, local_path)
     return local_path
 
 
+def retry(download, file, max_attempts=3):
+    """Call download() until it succeeds, retrying on network errors.
+
+    Arguments:
+        download (callable): function performing one download attempt
+        file (str): name of the file in the repository
+        max_attempts (int): number of download attempts
+    """
+    from requests import RequestException
+    attempt = 0
+    result = None
+    while attempt < max_attempts:
+        attempt += 1
+        logging.debug(f'download attempt {attempt}/{max_attempts} ...')
+        try:
+            result = download()
+            break
+        except RequestException as e:
+            print(f'error: {e}', file=sys.stderr)
+            status = getattr(e.response, 'status_code', None)
+            if attempt == max_attempts or (
+                    status is not None and status < 500):
+                raise
+    if result is None:
+        raise LoadError(file, 'download failed')
+    return result
+
+
 def attempt_to_download_file(
         repository,
         file,
         local_path,
         max_attempts=3,
-        callback=None):
+        callback=None,
+        segments=1,
+        metrics=None):
     """Retry to download a file several times if necessary.
 
+    Network errors keep the partial download so that the next attempt
+    (or the next call) can resume it.
+
     Arguments:
         repository (Repository): repository object
         file (str): name of the file in the repository
         local_path (str): local path where the file should be saved
         max_attempts (int): number of download attempts
         callback (callable): callback function
+        segments (int): number of concurrent byte ranges for large files
+        metrics (FileMetrics): records the phases of all attempts
     """
-    attempt = 0
-    filename = None
+    return retry(
+        partial(
+            download_file,
+            repository,
+            file,
+            local_path,
+            callback=callback,
+            segments=segments,
+            metrics=metrics),
+        file,
+        max_attempts=max_attempts)
 
-    def fault_handler(filename, exception):
-        print(f'error: {exception}', file=sys.stderr)
-        try:
-            # remove faulty files
-            os.unlink(filename)
-        except:
-            print(f'warning: could not remove file {filename}', file=sys.stderr)
-        raise exception
 
-    while attempt < max_attempts:
-        attempt += 1
-        logging.debug(f'download attempt {attempt}/{max_attempts} ...')
-        try:
-            filename = download_file(
-                repository,
-                file,
-                local_path,
-                callback=callback)
-            break
-        except (HTTPError, IOError, KeyboardInterrupt) as e:
-            fault_handler(filename, e)
-    if filename is None:
-        raise LoadError(file, 'download failed')
-    return filename
+def gzip_block(data):
+    """Compress data into a single, self-contained gzip member."""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_blocks(source, target, block_size, max_workers=None):
+    """Compress a stream as independent gzip members on all cores.
+
+    The concatenated members form a regular gzip file, but each block can
+    be decompressed on its own (like BGZF).
+
+    Arguments:
+        source (file object): uncompressed input
+        target (file object): compressed output
+        block_size (int): number of uncompressed bytes per block
+        max_workers (int): number of compression threads, defaults to
+            the number of cores
+
+    Returns the offsets of all blocks in the compressed output.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    offsets = []
+    offset = 0
+    pending = deque()
+
+    def write(future):
+        nonlocal offset
+        data = future.result()
+        offsets.append(offset)
+        target.write(data)
+        offset += len(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            pending.append(executor.submit(gzip_block, block))
+            if len(pending) >= 2 * max_workers:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    return offsets
+
+
+class BlockReader(object):
+    """Read-only file object which decompresses the blocks of a stream
+    written by compress_blocks() in parallel.
+
+    Arguments:
+        fileobj (file object): compressed input
+        offsets (list of int): offsets of the blocks
+        size (int): total size of the compressed input
+        max_workers (int): number of decompression threads, defaults to
+            the number of cores
+    """
+    def __init__(self, fileobj, offsets, size, max_workers=None):
+        max_workers = max_workers or os.cpu_count() or 1
+        self._fileobj = fileobj
+        self._sizes = deque(
+            stop - start
+            for start, stop in zip(offsets, list(offsets[1:]) + [size]))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_pending = 2 * max_workers
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def _submit(self):
+        while self._sizes and len(self._pending) < self._max_pending:
+            data = self._fileobj.read(self._sizes.popleft())
+            self._pending.append(
+                self._executor.submit(zlib.decompress, data, 31))
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            self._submit()
+            if not self._pending:
+                break
+            self._buffer += self._pending.popleft().result()
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        # blocks which were not read yet need not be decompressed
+        while self._pending:
+            self._pending.popleft().cancel()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+def container_members(fh, working_directory=None):
+    """Yield the top-level members of an open tar archive.
+
+    Existing files in the working directory are removed before their
+    member is yielded so that extraction never writes through a link.
+    """
+    for member in fh:
+        path, filename = os.path.split(member.name)
+        if path == '':
+            if working_directory is not None:
+                target = os.path.join(working_directory, filename)
+                if os.path.lexists(target):
+                    os.remove(target)
+            yield member
+
+
+def extract_member(fh, member, working_directory, algorithm):
+    """Write a regular file member of an open tar archive while hashing it.
+
+    Returns the hexdigest of the member's content.
+    """
+    hash_ = hashlib.new(algorithm)
+    path = os.path.join(working_directory, member.name)
+    source = fh.extractfile(member)
+    with open(path, 'wb') as target:
+        for data in iter(partial(source.read, 65536), b''):
+            hash_.update(data)
+            target.write(data)
+    fh.chmod(member, path)
+    fh.utime(member, path)
+    return hash_.hexdigest()
+
+
+def extract_container(
+        archive, working_directory, blocks=None, size=None, members=None,
+        checksums=None):
+    """Extract the top-level members of a .tar.gz container in one pass.
+
+    Arguments:
+        archive (str or file object): path of the container or a stream
+        working_directory (str): directory where the members should be saved
+        blocks (list of int): block offsets of a block-compressed container
+        size (int): size of a block-compressed stream in bytes
+        members (dict): catalogue entries of the members; those with a
+            known digest are hashed while they are written
+        checksums (dict): receives filename -> (algorithm, hexdigest) of
+            the hashed members
+
+    Returns the paths of the extracted members.
+    """
+    if isinstance(archive, str):
+        with open(archive, 'rb') as fh:
+            return extract_container(
+                fh, working_directory,
+                blocks=blocks, size=os.path.getsize(archive),
+                members=members, checksums=checksums)
+    names = []
+
+    def extract(fh):
+        for member in container_members(fh, working_directory):
+            names.append(member.name)
+            digest = select_digest((members or dict()).get(member.name, {}))
+            if digest is None or checksums is None or not member.isfile():
+                fh.extract(member, path=working_directory)
+                continue
+            algorithm, _ = digest
+            checksums[member.name] = algorithm, extract_member(
+                fh, member, working_directory, algorithm)
+
+    if blocks is None:
+        with tarfile.open(fileobj=archive, mode='r|gz') as fh:
+            extract(fh)
+    else:
+        with BlockReader(archive, blocks, size) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as fh:
+                extract(fh)
+    return [os.path.join(working_directory, name) for name in names]
+
+
+class StreamReader(object):
+    """Read-only file object over a streamed response which feeds the
+    data into a hash object and reports progress to a callback."""
+    def __init__(self, response, hash_, callback=None, metrics=None):
+        self._chunks = measure(
+            throttle(response.iter_content(BLOCKSIZE)), metrics)
+        self._buffer = bytearray()
+        self._hash = hash_
+        self._callback = callback
+        self.downloaded = 0
+
+    def _fill(self, size):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                data = next(self._chunks)
+            except StopIteration:
+                break
+            self._hash.update(data)
+            self.downloaded += len(data)
+            if self._callback is not None:
+                self._callback(self.downloaded, 1)
+            self._buffer += data
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class VerifiedStream(object):
+    """Read-only file object over a repository file which is verified
+    without touching the disk.
+
+    The data is hashed while it is read; reaching the end of the file
+    raises a LoadError if the size or checksum does not match. Broken
+    transfers are resumed at the current position via a Range request.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the file in the repository
+        max_attempts (int): number of attempts to (re)open the transfer
+        callback (callable): callback function
+    """
+    def __init__(self, repository, file, max_attempts=3, callback=None):
+        _, metadata = repository.lookup(file)
+        self.repository = repository
+        self.file = file
+        self.size = metadata['size']
+        self.algorithm, self._expected = repository.digest(file)
+        self.max_attempts = max_attempts
+        self._hash = hashlib.new(self.algorithm)
+        self._callback = callback
+        self._chunks = None
+        self._buffer = bytearray()
+        self._attempts = 0
+        self.position = 0
+        self.verified = False
+
+    def _open(self):
+        headers = None
+        if self.position > 0:
+            headers = {'Range': f'bytes={self.position}-'}
+        _, response = open_stream(self.repository, self.file, headers=headers)
+        if self.position > 0 and response.status_code != 206:
+            response.close()
+            raise LoadError(self.file, 'cannot resume stream')
+        self._chunks = throttle(response.iter_content(BLOCKSIZE))
+
+    def _next(self):
+        from requests import RequestException
+        while True:
+            try:
+                if self._chunks is None:
+                    if self.position >= self.size:
+                        return b''
+                    self._attempts += 1
+                    self._open()
+                return next(self._chunks, b'')
+            except RequestException as e:
+                logging.debug(f'stream of {self.file} broke: {e}')
+                self._chunks = None
+                status = getattr(e.response, 'status_code', None)
+                if self._attempts >= self.max_attempts or (
+                        status is not None and status < 500):
+                    raise
+
+    def _read_chunk(self):
+        if self.verified:
+            return b''
+        data = self._next()
+        if not data:
+            self._verify()
+            return data
+        self._hash.update(data)
+        self.position += len(data)
+        if self._callback is not None:
+            self._callback(self.position, 1)
+        return data
+
+    def _fill(self, size):
+        while size < 0 or len(self._buffer) < size:
+            data = self._read_chunk()
+            if not data:
+                break
+            self._buffer += data
+
+    def _verify(self):
+        if self.position != self.size:
+            raise LoadError(
+                self.file, f'stream ended after {self.position} bytes')
+        if self._hash.hexdigest() != self._expected:
+            raise LoadError(self.file, 'checksum test failed')
+        self.verified = True
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def __iter__(self):
+        if self._buffer:
+            yield self.read()
+        while True:
+            data = self._read_chunk()
+            if not data:
+                break
+            yield data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._chunks = None
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+def download_and_extract(
+        repository, file, working_directory, callback=None, metrics=None,
+        checksums=None):
+    """Extract a .tar.gz container while it is being downloaded.
+
+    Members are written to a staging directory and only moved into the
+    working directory once the checksum of the archive has been verified.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the container in the repository
+        working_directory (str): directory where the members should be saved
+        callback (callable): callback function
+        metrics (FileMetrics): records the phases of the download
+        checksums (dict): receives filename -> (algorithm, hexdigest) of
+            the members, computed while they are extracted
+    """
+    _, metadata = repository.lookup(file)
+    algorithm, expected = repository.digest(file)
+    logging.debug(
+        f'From <{repository.url_for(file)}> stream-extract'
+        f' to <{working_directory}>')
+    if metrics is not None:
+        metrics.source = 'network'
+    _, response = open_stream(repository, file, metrics=metrics)
+    hash_ = hashlib.new(algorithm)
+    reader = StreamReader(
+        response, hash_, callback=callback, metrics=metrics)
+    staging = mkdtemp(prefix='.mdshare-', dir=working_directory)
+    computed = dict()
+    try:
+        names = [
+            os.path.basename(path) for path in extract_container(
+                reader, staging,
+                blocks=metadata.get('blocks'), size=metadata['size'],
+                members=repository.members(file), checksums=computed)]
+        # the archive may end with padding that tarfile does not read
+        while reader.read(BLOCKSIZE):
+            pass
+        if hash_.hexdigest() != expected:
+            raise LoadError(file, 'checksum test failed')
+        paths = []
+        for name in names:
+            path = os.path.join(working_directory, name)
+            os.replace(os.path.join(staging, name), path)
+            paths.append(path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    if checksums is not None:
+        checksums.update(computed)
+    return paths
+
+
+def attempt_to_download_and_extract(
+        repository,
+        file,
+        working_directory,
+        max_attempts=3,
+        callback=None,
+        metrics=None,
+        checksums=None):
+    """Retry to stream-extract a container several times if necessary.
+
+    Arguments:
+        repository (Repository): repository object
+        file (str): name of the container in the repository
+        working_directory (str): directory where the members should be saved
+        max_attempts (int): number of download attempts
+        callback (callable): callback function
+        metrics (FileMetrics): records the phases of all attempts
+        checksums (dict): receives the members' computed checksums
+    """
+    return retry(
+        partial(
+            download_and_extract,
+            repository,
+            file,
+            working_directory,
+            callback=callback,
+            metrics=metrics,
+            checksums=checksums),
+        file,
+        max_attempts=max_attempts)
 
 
 def download_wrapper(
         repository, file, working_directory='.',
-        max_attempts=3, force=False, callback=None):
+        max_attempts=3, force=False, callback=None, segments=1,
+        cache=None, verify='none', metrics=None, manifest=None):
     """Download a file if necessary.
 
     Arguments:
@@ -146,24 +909,64 @@ def download_wrapper(
         max_attempts (int): number of download attempts
         force (boolean): enforce download even if file exists
         callback (callable): callback function
+        segments (int): number of concurrent byte ranges for large files
+        cache (Cache): shared cache to materialize the file from
+        verify (str): check of an existing file: 'none' (existence only),
+            'fast' (size/mtime/inode manifest, hash on mismatch), 'full'
+        metrics (FileMetrics): records the phases of the download
+        manifest (Manifest): manifest of the working directory, e.g., to
+            batch the records of several downloads
     """
+    from .manifest import Manifest
+    from .locking import FileLock
     logging.debug(
         f'download_wrapper({repository.url}, {file},'
         f' working_directory="{working_directory}",'
-        f' max_attempts={max_attempts}, force={force})')
+        f' max_attempts={max_attempts}, force={force}, verify={verify})')
     if working_directory is None:
         raise RuntimeError(
             'working_directory=None is illegal at this point')
     local_path = os.path.join(working_directory, file)
     logging.debug(f'local_path={local_path}')
-    if os.path.exists(local_path) and not force:
+    algorithm, expected = repository.digest(file)
+    if manifest is None:
+        manifest = Manifest(working_directory)
+
+    def present():
+        with phase(metrics, 'hash'):
+            return manifest.verify(
+                file, algorithm, expected,
+                size=repository.size(file), mode=verify)
+
+    if not force and present():
         logging.debug(f'local_path={local_path} exists ... return')
         return local_path
-    logging.debug(
-        f'local_path={local_path} does not exist ... attempting download')
-    return attempt_to_download_file(
-        repository,
-        file,
-        local_path,
-        max_attempts=max_attempts,
-        callback=callback)
+    # one process downloads the file while the others wait for it
+    with FileLock(local_path) as lock:
+        if (not force or lock.waited) and present():
+            logging.debug(f'local_path={local_path} was downloaded meanwhile')
+            return local_path
+        if cache is not None:
+            cache.retrieve(
+                repository,
+                file,
+                local_path,
+                max_attempts=max_attempts,
+                force=force,
+                callback=callback,
+                segments=segments,
+                metrics=metrics)
+        else:
+            logging.debug(
+                f'local_path={local_path} is missing or invalid'
+                ' ... attempting download')
+            attempt_to_download_file(
+                repository,
+                file,
+                local_path,
+                max_attempts=max_attempts,
+                callback=callback,
+                segments=segments,
+                metrics=metrics)
+        manifest.record(file, algorithm, expected)
+    return local_path
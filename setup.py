@@ -43,6 +43,7 @@ setup(
     install_requires=['humanfriendly',
                       'requests',
                       ],
+    extras_require={'arrays': ['numpy']},
     tests_require=['pytest'],
     zip_safe=False,
     scripts=['bin/mdshare-index-maker.py'],